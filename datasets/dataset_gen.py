@@ -2,14 +2,34 @@
 
 import csv
 import cPickle
+import functools
 import gzip
+import hashlib
+import itertools
+import json
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
 import random as rnd
+import shutil
+from numpy.lib.stride_tricks import as_strided
 
 # Parameters for reader
 DATA_DIRECTORY = "../data"
+COLUMNAR_READER = True
+READER_WORKERS = 1
+
+# Parsed columns of each data file are cached here (None disables caching)
+CACHE_DIRECTORY = "cache"
+CACHE_VERSION = 2
+
+# Positions of the columns in the data files
+COLUMNS = {"date": 0, "well": 3, "oil": 4, "water": 5, "gas": 6}
+
+# Series used as input channels (more than one gives chunk inputs of shape
+# (IN_MONTHS, channels); requires COLUMNAR_READER); outputs are always oil
+CHANNELS = ("oil",)
 
 # Splitting data
 IN_MONTHS = 48
@@ -18,11 +38,56 @@ STEP_MONTHS = 6
 
 # Preprocessing parameters
 REMOVE_ZEROS = True
+GAP_HANDLING = "drop"  # Months without oil: "drop", "ffill" or "mask"
 NORMALIZE_DATA = True
 
+# Also write the memory-mapped dataset (raw float32 arrays and JSON header)
+MEMMAP_DATASET = True
+MEMMAP_DIRECTORY = "qri_memmap"
+
+# Only append chunks made possible by newly added months to the existing
+# memory-mapped dataset (wells keep their dataset assignment)
+INCREMENTAL_UPDATE = False
+
+# Stream the data files well by well straight into the memory-mapped dataset
+# (wells are assigned by a hash of their name instead of a shuffle)
+STREAMING = False
+BLOCK_ROWS = 65536
+FLUSH_CHUNKS = 65536
+
+# Also write the windowed dataset (well series stored once, chunks by offset)
+WINDOWED_DATASET = True
+
+# Index of the chunks of each well (written next to qri.pkl.gz and inside the
+# memory-mapped dataset directory)
+INDEX_FILENAME = "qri_index.npz"
+MEMMAP_INDEX_NAME = "index.npz"
+
+# Also write the cross-validation dataset: the chunks of all wells stored
+# once with K well-grouped folds and rolling-origin folds as row indices
+CV_DATASET = False
+CV_DIRECTORY = "qri_cv"
+CV_FOLDS = 8
+ROLLING_ORIGINS = 5
+ROLLING_STEP_MONTHS = 24
+
+# Assign wells to datasets by site (the first SITE_LENGTH characters of the
+# well name) instead of at random; wells of unlisted sites are left out
+DIFFERENT_SITES = False
+SITE_LENGTH = 4
+TRAIN_SITES = ["BEAP", "BEAT", "BEZE", "EUZE", "EUAP"]
+VALID_SITES = ["BEDE"]
+TEST_SITES = ["EUAT"]
+
+# Longer series are decimated to about this many points before plotting
+PLOT_POINTS = 500
+
 # Random seed
 SEED = 42
 
+# Names of the datasets in the order they are returned
+SPLIT_NAMES = ("train", "valid", "test")
+
 def get_data():
     """Returns dictionary containing data from files in data directory"""
     # Oil production data is contained in this dictionary
@@ -61,59 +126,432 @@ def get_data():
     return data
 
 
-def preprocess_data(data):
+def select_bytes(buf, starts, ends):
+    """Returns the bytes of buf lying in the disjoint spans [starts, ends)"""
+    # Toggle at every span boundary and accumulate into an inside-span mask
+    toggles = np.zeros(len(buf) + 1, dtype=bool)
+    toggles[starts] = True
+    toggles[ends] ^= True
+    return buf[np.logical_xor.accumulate(toggles)[:-1]]
+
+
+def float_column(buf, starts, ends, dtype=np.float32):
+    """Returns array of numbers parsed from the fields between starts/ends"""
+    # Keep the fields with their trailing delimiters and join them by commas
+    text = select_bytes(buf, starts, ends + 1)
+    text[text == ord("\n")] = ord(",")
+
+    # Parse the whole column at once with NumPy's C parser
+    return np.fromstring(text[:-1].tostring(), dtype=dtype, sep=",")
+
+
+def text_column(buf, starts, ends):
+    """Returns fixed-width string array of the fields between starts/ends"""
+    # Gather the bytes of every field into a zero-padded character matrix
+    lengths = ends - starts
+    offsets = np.arange(max(lengths.max(), 1))
+    chars = buf[np.minimum(starts[:, np.newaxis] + offsets, len(buf) - 1)]
+    chars[offsets >= lengths[:, np.newaxis]] = 0
+    return chars.view("S%d" % len(offsets)).ravel()
+
+
+def month_column(buf, starts, ends):
+    """Returns month indices (year*12 + month - 1) of M/D/YYYY date fields"""
+    # Month has one or two digits, year is always the last four characters
+    digit = lambda index: buf[index].astype(np.int32) - ord("0")
+    month = np.where(buf[starts + 1] == ord("/"), digit(starts),
+                     10*digit(starts) + digit(starts + 1))
+    year = (1000*digit(ends - 4) + 100*digit(ends - 3) +
+            10*digit(ends - 2) + digit(ends - 1))
+    return 12*year + month - 1
+
+
+def read_columns(filename, names=("date", "well", "oil", "water", "gas")):
+    """Returns dictionary of the named column arrays parsed from a data file"""
+    # Read file without the header line
+    with open(filename, "rb") as csvfile:
+        csvfile.readline()
+        return parse_columns(csvfile.read(), names, filename)
+
+
+def parse_columns(text, names=("date", "well", "oil", "water", "gas"),
+                  filename="data rows"):
+    """Returns dictionary of the named column arrays parsed from data rows
+       (of the named file)"""
+    text = text.replace("\r", "").rstrip("\n") + "\n"
+    buf = np.frombuffer(text, dtype=np.uint8)
+
+    # Find where every field ends (each row has the same number of fields)
+    ends = np.flatnonzero((buf == ord(",")) | (buf == ord("\n")))
+    ends = ends.reshape(text.count("\n"), -1)
+    starts = np.empty_like(ends)
+    starts[:, 1:] = ends[:, :-1] + 1
+    starts[0, 0] = 0
+    starts[1:, 0] = ends[:-1, -1] + 1
+
+    # Convert only the requested columns, each with vectorized operations
+    columns = {}
+    for name in names:
+        index = COLUMNS[name]
+        if name == "date":
+            parse = month_column
+        elif name == "well":
+            parse = text_column
+        else:
+            parse = float_column
+        columns[name] = parse(buf, starts[:, index], ends[:, index])
+
+        # NumPy stops at the first blank or non-numeric field without error
+        if len(columns[name]) != len(ends):
+            raise ValueError("Column %s of %s has a blank or non-numeric "
+                             "field (parsed %d of %d rows)"
+                             % (name, filename, len(columns[name]), len(ends)))
+    return columns
+
+
+def concat_columns(columns_list):
+    """Returns the column arrays of several files joined end to end"""
+    return dict((key, np.concatenate([columns[key] for columns in columns_list]))
+                for key in columns_list[0])
+
+
+def group_by_well(wells, values):
+    """Returns dictionary mapping well names to their rows of values"""
+    # Rows of a well usually come in one run, so only run heads are compared
+    run_starts = np.append(0, np.flatnonzero(wells[1:] != wells[:-1]) + 1)
+    well_names, run_codes = np.unique(wells[run_starts], return_inverse=True)
+
+    # Each well is a single run, so no sorting is needed
+    if len(well_names) == len(run_starts):
+        return dict(zip(well_names[run_codes],
+                        np.split(values, run_starts[1:])))
+
+    # Otherwise encode wells as integer codes and stable sort by code
+    codes = np.repeat(run_codes, np.diff(np.append(run_starts, len(wells))))
+    order = np.argsort(codes, kind="mergesort")
+    bounds = np.cumsum(np.bincount(codes, minlength=len(well_names)))[:-1]
+    return dict(zip(well_names, np.split(values[order], bounds)))
+
+
+def file_hash(filename):
+    """Returns SHA-1 hex digest of the contents of a file"""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), ""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def write_cache(cachename, key, columns):
+    """Writes cache entry of a data file's columns atomically"""
+    if not os.path.isdir(CACHE_DIRECTORY):
+        try:
+            os.makedirs(CACHE_DIRECTORY)
+        except OSError:
+            pass
+    entry = dict(key)
+    entry.update(columns)
+    tempname = "%s.%d.tmp.npz" % (cachename[:-4], os.getpid())
+    np.savez(tempname, **entry)
+    os.rename(tempname, cachename)
+
+
+def read_cached_columns(filename, names=("date", "well", "oil", "water", "gas")):
+    """Returns the named columns of a data file, parsing it only if it changed
+       since its columns were cached"""
+    if CACHE_DIRECTORY is None:
+        return read_columns(filename, names)
+
+    # Cache entry is keyed on file size, modification time and contents
+    cachename = os.path.join(CACHE_DIRECTORY,
+                             os.path.basename(filename) + ".npz")
+    stat = os.stat(filename)
+    key = {"version": CACHE_VERSION, "size": stat.st_size,
+           "mtime": stat.st_mtime, "sha1": None}
+
+    # Use cached columns if the file is unchanged (hash only if stat differs)
+    if os.path.exists(cachename):
+        with np.load(cachename) as cache:
+            if int(cache["version"]) == CACHE_VERSION:
+                if (int(cache["size"]) == stat.st_size and
+                    float(cache["mtime"]) == stat.st_mtime):
+                    return dict((name, cache[name]) for name in names)
+                key["sha1"] = file_hash(filename)
+                if str(cache["sha1"]) == key["sha1"]:
+                    # Contents are the same, so only refresh the key
+                    columns = dict((name, cache[name]) for name in COLUMNS)
+                    write_cache(cachename, key, columns)
+                    return dict((name, columns[name]) for name in names)
+
+    # Parse the file and cache all of its columns
+    columns = read_columns(filename)
+    key["sha1"] = key["sha1"] or file_hash(filename)
+    write_cache(cachename, key, columns)
+    return dict((name, columns[name]) for name in names)
+
+
+def map_files(function, filenames, workers=1):
+    """Returns function applied to each file, in order, using a process pool
+       when more than one worker is requested"""
+    if workers <= 1 or len(filenames) <= 1:
+        return map(function, filenames)
+    pool = multiprocessing.Pool(min(workers, len(filenames)))
+    try:
+        return pool.map(function, filenames, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def data_filenames():
+    """Returns paths of the files in the data directory"""
+    return [os.path.join(DATA_DIRECTORY, filename)
+            for filename in os.listdir(DATA_DIRECTORY)]
+
+
+def read_data_columns(names=("date", "well", "oil", "water", "gas"),
+                      workers=READER_WORKERS):
+    """Returns the named columns of all files in the data directory"""
+    read = functools.partial(read_cached_columns, names=names)
+    return concat_columns(map_files(read, data_filenames(), workers))
+
+
+def channel_values(columns):
+    """Returns the values of the input channels (one column per channel if
+       there is more than one)"""
+    if len(CHANNELS) == 1:
+        return columns[CHANNELS[0]]
+    return np.column_stack([columns[name] for name in CHANNELS])
+
+
+def align_months(months, values):
+    """Returns values placed on consecutive calendar months from the first to
+       the last month of the well (months without a row are zero)"""
+    first = months.min()
+    aligned = np.zeros((months.max() - first + 1,) + values.shape[1:],
+                       dtype=values.dtype)
+    aligned[months - first] = values
+    return aligned
+
+
+def get_data_columnar(workers=READER_WORKERS, first_months=None):
+    """Returns the same dictionary as get_data using columnar parsing (with a
+       row per calendar month and a column per channel if there are several);
+       the first month of each well is stored in first_months if given"""
+    # Parse every file in the data directory into column arrays
+    columns = read_data_columns(("date", "well") + CHANNELS, workers)
+    values = channel_values(columns)
+
+    # Split row indices by well and align production to calendar months
+    rows = group_by_well(columns["well"], np.arange(len(values)))
+    if first_months is not None:
+        first_months.update((well_name, int(columns["date"][index].min()))
+                            for well_name, index in rows.items())
+
+    # Add wells in the order they first appear, like get_data, so that the
+    # dictionary (and the shuffle of its keys) matches get_data
+    data = {}
+    for well_name in sorted(rows, key=lambda well_name: rows[well_name][0]):
+        index = rows[well_name]
+        data[str(well_name)] = align_months(columns["date"][index],
+                                            values[index])
+    return data
+
+
+def window_starts(length, in_months=IN_MONTHS, out_months=OUT_MONTHS,
+                  step_months=STEP_MONTHS):
+    """Returns start indices of the chunks of a series of given length"""
+    return np.arange(0, length - (in_months + out_months), step_months)
+
+
+def make_windows(series, in_months=IN_MONTHS, out_months=OUT_MONTHS,
+                 step_months=STEP_MONTHS):
+    """Returns read-only strided view with one chunk of the series per row"""
+    series = np.ascontiguousarray(series)
+    count = len(window_starts(len(series), in_months, out_months, step_months))
+
+    # Consecutive rows start step_months apart in the same memory
+    shape = (count, in_months + out_months) + series.shape[1:]
+    strides = (step_months*series.strides[0],) + series.strides
+    return as_strided(series, shape=shape, strides=strides, writeable=False)
+
+
+def normalize_windows(x, y):
+    """Returns chunks normalized with respect to the mean/std of each x (per
+       channel for multi-channel chunks); constant inputs are only centered"""
+    mean = x.mean(axis=1, keepdims=True)
+    std = x.std(axis=1, keepdims=True)
+    std[std == 0] = 1
+    return (x - mean)/std, (y - mean)/std
+
+
+def make_chunks(series):
+    """Returns (x, y) arrays of all chunks of a preprocessed series"""
+    windows = make_windows(series)[valid_windows(series)]
+    chunk_x = windows[:, :IN_MONTHS]
+    chunk_y = windows[:, IN_MONTHS:]
+
+    # Normalize chunks w/respect to x
+    if NORMALIZE_DATA:
+        chunk_x, chunk_y = normalize_windows(chunk_x, chunk_y)
+
+    # Only oil production is predicted
+    return chunk_x, chunk_y[..., 0] if chunk_y.ndim == 3 else chunk_y
+
+
+def chunk_shapes():
+    """Returns shapes of a chunk's x and y"""
+    if len(CHANNELS) == 1:
+        return (IN_MONTHS,), (OUT_MONTHS,)
+    return (IN_MONTHS, len(CHANNELS)), (OUT_MONTHS,)
+
+
+def join_chunks(xs, ys):
+    """Returns (x, y) datasets from the lists of chunk arrays of each one"""
+    x_shape, y_shape = chunk_shapes()
+    empty_x = np.empty((0,) + x_shape, np.float32)
+    empty_y = np.empty((0,) + y_shape, np.float32)
+    return [(np.concatenate([empty_x] + x), np.concatenate([empty_y] + y))
+            for x, y in zip(xs, ys)]
+
+
+def shuffle_wells(data):
+    """Returns the well names of the data in random order"""
+    well_names = data.keys()
+    rnd.shuffle(well_names)
+    return well_names
+
+
+def oil_gaps(series):
+    """Returns boolean mask of the months of a series without oil production"""
+    return (series[:, 0] if series.ndim == 2 else series) == 0
+
+
+def producing_span(gaps):
+    """Returns slice from the first to the last month with oil production
+       (empty if the well never produced)"""
+    if gaps.all():
+        return slice(0, 0)
+    return slice(np.argmin(gaps), len(gaps) - np.argmin(gaps[::-1]))
+
+
+def clean_series(values):
+    """Returns float32 series of a well with preprocessing applied"""
+    series = np.asarray(values, dtype=np.float32)
+    if not REMOVE_ZEROS or GAP_HANDLING == "mask":
+        return series
+    gaps = oil_gaps(series)
+
+    # Remove months without oil production (push points together)
+    if GAP_HANDLING == "drop":
+        return series[~gaps]
+
+    # Repeat the last month with production over gaps (leading and trailing
+    # gaps dropped, so a well that was shut in keeps no invented months)
+    if GAP_HANDLING == "ffill":
+        last = np.maximum.accumulate(np.where(gaps, 0, np.arange(len(series))))
+        return series[last][producing_span(gaps)]
+    raise ValueError("Unknown GAP_HANDLING %r" % GAP_HANDLING)
+
+
+def series_months(values, first_month=None):
+    """Returns calendar month index of each month kept by clean_series (-1 if
+       the first month of the well is unknown)"""
+    gaps = oil_gaps(np.asarray(values))
+    months = np.arange(len(gaps), dtype=np.int32)
+    if first_month is None:
+        months[:] = -1
+    else:
+        months += first_month
+
+    # Same months as clean_series keeps
+    if REMOVE_ZEROS and GAP_HANDLING == "drop":
+        return months[~gaps]
+    if REMOVE_ZEROS and GAP_HANDLING == "ffill":
+        return months[producing_span(gaps)]
+    return months
+
+
+def valid_windows(series):
+    """Returns boolean mask of the chunks of a series to keep (with "mask" gap
+       handling, chunks containing a month without oil are skipped)"""
+    count = len(window_starts(len(series)))
+    if not REMOVE_ZEROS or GAP_HANDLING != "mask":
+        return np.ones(count, dtype=bool)
+    return ~make_windows(oil_gaps(series)).any(axis=1)[:count]
+
+
+def chunk_starts(series):
+    """Returns start offsets of the chunks kept from a preprocessed series"""
+    return window_starts(len(series))[valid_windows(series)]
+
+
+def chunk_months(values, first_month=None):
+    """Returns (offsets, months) of the chunks of a well: start offset in the
+       preprocessed series and calendar month index of the first input month"""
+    offsets = chunk_starts(clean_series(values))
+    return offsets, series_months(values, first_month)[offsets]
+
+
+def well_split(well_index, well_count):
+    """Returns the dataset (0 train, 1 valid, 2 test) of the well at the
+       given index, assigning wells in a 6:1:1 ratio"""
+    if well_index < well_count*6/8:
+        return 0
+    elif well_index < well_count*7/8:
+        return 1
+    else:
+        return 2
+
+
+def site_splits(well_names):
+    """Returns the dataset of each well from the site in its name (-1 for
+       wells whose site is not listed)"""
+    sites = np.array(well_names, dtype=str).astype("S%d" % SITE_LENGTH)
+    splits = np.empty(len(sites), dtype=np.int8)
+    splits.fill(-1)
+    for split, split_sites in enumerate((TRAIN_SITES, VALID_SITES,
+                                         TEST_SITES)):
+        splits[np.in1d(sites, split_sites)] = split
+    return splits
+
+
+def well_splits(well_names):
+    """Returns the dataset of each well in the given order, by site when
+       DIFFERENT_SITES is set or else by position in a 6:1:1 ratio"""
+    if DIFFERENT_SITES:
+        splits = site_splits(well_names)
+        for site in np.unique([well_name[:SITE_LENGTH] for well_name, split
+                               in zip(well_names, splits) if split < 0]):
+            print "Error: site %s not classified" % site
+        return splits
+    count = len(well_names)
+    return np.searchsorted([count*6/8, count*7/8], np.arange(count),
+                           side="right").astype(np.int8)
+
+
+def preprocess_data(data, well_names=None):
     """Returns preprocessed version of the data"""
-    # Initialize dataset components
-    train_x = []
-    train_y = [] 
-    valid_x = []
-    valid_y = []
-    test_x = []
-    test_y = []
+    # Initialize dataset components (chunk arrays of each well)
+    xs = ([], [], [])
+    ys = ([], [], [])
     
     # Shuffle wells
-    well_names = data.keys()
-    rnd.shuffle(well_names)
+    if well_names is None:
+        well_names = shuffle_wells(data)
     
-    # Go through wells and assign to datasets
-    for well_index, well_name in enumerate(well_names):
-        # Remove zeroed data points (push points together)
-        if REMOVE_ZEROS:
-            oils = np.array(filter(lambda oil: oil != 0, data[well_name]))
-        else:
-            oils = np.array(data[well_name])
-        
-        # Make chunks
-        for i in xrange(0, len(oils)-(IN_MONTHS+OUT_MONTHS), STEP_MONTHS):
-            # Split data into x, y, and chunk
-            in_index = i
-            out_index = i + IN_MONTHS
-            end_index = i + IN_MONTHS + OUT_MONTHS
-            chunk_x = oils[in_index:out_index]
-            chunk_y = oils[out_index:end_index]
-            
-            # Normalize chunk w/respect to x (skip if standard deviation is 0)
-            if NORMALIZE_DATA:
-                mean = np.mean(chunk_x)
-                std = np.std(chunk_x)
-                chunk_x = (chunk_x - mean)/std
-                chunk_y = (chunk_y - mean)/std
-                
-            # Assign to dataset based on well index
-            if well_index < len(data)*6/8:
-                train_x.append(chunk_x)
-                train_y.append(chunk_y)
-            elif well_index < len(data)*7/8:
-                valid_x.append(chunk_x)
-                valid_y.append(chunk_y)
-            else:
-                test_x.append(chunk_x)
-                test_y.append(chunk_y)
+    # Go through wells and assign to datasets (by well index or site)
+    for well_name, split in zip(well_names, well_splits(well_names)):
+        if split < 0:
+            continue
+
+        # Make all chunks of the well at once
+        chunk_x, chunk_y = make_chunks(clean_series(data[well_name]))
+        xs[split].append(chunk_x)
+        ys[split].append(chunk_y)
 
     # Make datasets
-    train_set = (np.array(train_x), np.array(train_y))
-    valid_set = (np.array(valid_x), np.array(valid_y))
-    test_set = (np.array(test_x), np.array(test_y))
+    train_set, valid_set, test_set = join_chunks(xs, ys)
     
     print "Training Set Size: %d" % train_set[0].shape[0]
     print "Validation Set Size: %d" % valid_set[0].shape[0]
@@ -122,6 +560,493 @@ def preprocess_data(data):
     return train_set, valid_set, test_set
 
 
+def preprocess_windows(data, well_names=None):
+    """Returns windowed version of the datasets: each well's series is stored
+       once and chunks are given by their start offsets into the series"""
+    # Initialize dataset components (series and chunk starts of each well)
+    series = ([], [], [])
+    starts = ([], [], [])
+    lengths = [0, 0, 0]
+
+    # Shuffle wells
+    if well_names is None:
+        well_names = shuffle_wells(data)
+
+    # Go through wells and assign to datasets
+    for well_name, split in zip(well_names, well_splits(well_names)):
+        if split < 0:
+            continue
+        oils = clean_series(data[well_name])
+
+        # Chunk index = well offset + chunk start in the well
+        series[split].append(oils)
+        starts[split].append(lengths[split] + chunk_starts(oils))
+        lengths[split] += len(oils)
+
+    # Make datasets
+    empty = np.empty((0,) + chunk_shapes()[0][1:], np.float32)
+    return [{"series": np.concatenate([empty] + split_series),
+             "starts": np.concatenate([np.empty(0, np.int64)] + split_starts),
+             "in_months": IN_MONTHS, "out_months": OUT_MONTHS,
+             "normalize": NORMALIZE_DATA}
+            for split_series, split_starts in zip(series, starts)]
+
+
+def build_index(wells, index=None):
+    """Returns chunk index extended by the (well name, dataset, offsets, months)
+       of wells whose chunks were appended, in order, to their datasets"""
+    # Wells are coded by their position in the index
+    index = index or {"wells": np.empty(0, "S1"),
+                      "splits": np.empty(0, np.int8)}
+    names = list(index["wells"])
+    splits = list(index["splits"])
+    codes = dict((well_name, code) for code, well_name in enumerate(names))
+    rows = {}
+    for name in SPLIT_NAMES:
+        for part, dtype in (("well", np.int32), ("offset", np.int32),
+                            ("month", np.int32)):
+            key = "%s_%s" % (name, part)
+            rows[key] = [index.get(key, np.empty(0, dtype))]
+
+    # Add a row per chunk with its well code, offset and start month
+    for well_name, split, offsets, months in wells:
+        if well_name not in codes:
+            codes[well_name] = len(names)
+            names.append(well_name)
+            splits.append(split)
+        splits[codes[well_name]] = split
+        name = SPLIT_NAMES[split]
+        rows[name + "_well"].append(np.repeat(np.int32(codes[well_name]),
+                                              len(offsets)))
+        rows[name + "_offset"].append(np.asarray(offsets, np.int32))
+        rows[name + "_month"].append(np.asarray(months, np.int32))
+    index = dict((key, np.concatenate(parts)) for key, parts in rows.items())
+    index["wells"] = np.array(names or [""], dtype=str)[:len(names)]
+    index["splits"] = np.array(splits, dtype=np.int8)
+
+    # Rows of each dataset sorted by well, so the rows of a well are the
+    # slice order[bounds[code]:bounds[code + 1]]
+    for name in SPLIT_NAMES:
+        well_codes = index[name + "_well"]
+        index[name + "_order"] = np.argsort(well_codes, kind="mergesort")
+        index[name + "_bounds"] = np.append(0, np.cumsum(
+            np.bincount(well_codes, minlength=len(names))))
+    return index
+
+
+def make_index(data, well_names, first_months=None):
+    """Returns chunk index of the datasets made by preprocess_data"""
+    first_months = first_months or {}
+    return build_index((well_name, split)
+                       + chunk_months(data[well_name],
+                                      first_months.get(well_name))
+                       for well_name, split in zip(well_names,
+                                                   well_splits(well_names))
+                       if split >= 0)
+
+
+def write_index(index, filename=INDEX_FILENAME):
+    """Writes chunk index to a .npz file atomically"""
+    tempname = "%s.%d.tmp.npz" % (filename[:-4], os.getpid())
+    np.savez(tempname, **index)
+    os.rename(tempname, filename)
+
+
+def read_index(filename=INDEX_FILENAME):
+    """Returns chunk index read from a .npz file (None if missing)"""
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as file:
+        index = dict((key, file[key]) for key in file.files)
+    index["codes"] = dict((well_name, code)
+                          for code, well_name in enumerate(index["wells"]))
+    return index
+
+
+def well_chunks(index, well_name):
+    """Returns (dataset name, chunk rows) of a well from the chunk index"""
+    code = index["codes"][well_name]
+    name = SPLIT_NAMES[index["splits"][code]]
+    bounds = index[name + "_bounds"]
+    return name, index[name + "_order"][bounds[code]:bounds[code + 1]]
+
+
+def chunk_info(index, name, row):
+    """Returns (well name, offset, start month) of a chunk of a dataset"""
+    return (index["wells"][index[name + "_well"][row]],
+            int(index[name + "_offset"][row]),
+            int(index[name + "_month"][row]))
+
+
+def well_dataset(datasets, index, well_name):
+    """Returns (x, y) of all chunks of a well, e.g. to evaluate or plot them"""
+    name, rows = well_chunks(index, well_name)
+    x, y = datasets[SPLIT_NAMES.index(name)]
+    return x[rows], y[rows]
+
+
+def generation_params():
+    """Returns dictionary of the parameters used to generate chunks"""
+    return {"in_months": IN_MONTHS, "out_months": OUT_MONTHS,
+            "channels": list(CHANNELS), "gap_handling": GAP_HANDLING,
+            "step_months": STEP_MONTHS, "remove_zeros": REMOVE_ZEROS,
+            "normalize_data": NORMALIZE_DATA, "seed": SEED,
+            "sites": [TRAIN_SITES, VALID_SITES, TEST_SITES]
+                     if DIFFERENT_SITES else None}
+
+
+def read_header(directory=MEMMAP_DIRECTORY):
+    """Returns the JSON header of a memory-mapped dataset (None if missing)"""
+    filename = os.path.join(directory, "header.json")
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as file:
+        return json.load(file)
+
+
+def write_header(header, directory=MEMMAP_DIRECTORY):
+    """Writes the JSON header of a memory-mapped dataset atomically"""
+    filename = os.path.join(directory, "header.json")
+    with open(filename + ".tmp", "w") as file:
+        json.dump(header, file, indent=4, sort_keys=True)
+    os.rename(filename + ".tmp", filename)
+
+
+def new_header():
+    """Returns the header of an empty memory-mapped dataset"""
+    x_shape, y_shape = chunk_shapes()
+    return {"dtype": "float32", "params": generation_params(), "wells": {},
+            "shapes": dict((name, {"x": [0] + list(x_shape),
+                                   "y": [0] + list(y_shape)})
+                           for name in SPLIT_NAMES)}
+
+
+def append_memmap(header, datasets, directory=MEMMAP_DIRECTORY):
+    """Appends (x, y) chunks of each dataset to its raw float32 files and
+       updates the shapes in the header (the header is not written)"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name, dataset in zip(SPLIT_NAMES, datasets):
+        for part, array in zip(("x", "y"), dataset):
+            filename = os.path.join(directory, "%s_%s.bin" % (name, part))
+            shape = header["shapes"][name][part]
+            array = np.asarray(array, dtype=np.float32)
+
+            # Drop anything past the rows in the header (interrupted append)
+            with open(filename, "r+b" if os.path.exists(filename) else "wb") \
+                    as file:
+                file.truncate(shape[0]*int(np.prod(shape[1:]))*4)
+                file.seek(0, os.SEEK_END)
+                array.tofile(file)
+            shape[0] += len(array)
+
+
+def update_memmap(data, directory=MEMMAP_DIRECTORY, well_names=None,
+                  first_months=None):
+    """Appends the chunks of the data that are not yet in the memory-mapped
+       dataset and to its chunk index; returns the number of chunks added to
+       each dataset"""
+    # Chunks can only be added if they are made the same way
+    header = read_header(directory) or new_header()
+    params = generation_params()
+    for key in params:
+        if key != "seed" and header["params"].get(key) != params[key]:
+            raise ValueError("Parameter %s differs from %s, rebuild dataset"
+                             % (key, directory))
+
+    # The wells of a new dataset are shuffled and assigned in the usual 6:1:1
+    # ratio by position; wells added to an existing dataset are assigned one
+    # by one by hash_split, as the position rule is skewed for a few wells
+    # (by site either way, wells of unlisted sites are left out)
+    wells = header["wells"]
+    if well_names is None:
+        well_names = shuffle_wells(data)
+    new_wells = [well_name for well_name in well_names
+                 if well_name not in wells]
+    if wells and not DIFFERENT_SITES:
+        splits = [hash_split(well_name) for well_name in new_wells]
+    else:
+        splits = well_splits(new_wells)
+    for well_name, split in zip(new_wells, splits):
+        if split >= 0:
+            wells[well_name] = {"split": SPLIT_NAMES[split], "chunks": 0}
+    well_names = [well_name for well_name in well_names if well_name in wells]
+
+    # Make only the chunks past the ones each well already has
+    xs = dict((name, []) for name in SPLIT_NAMES)
+    ys = dict((name, []) for name in SPLIT_NAMES)
+    rows = []
+    first_months = first_months or {}
+    for well_name in well_names:
+        well = wells[well_name]
+        chunk_x, chunk_y = make_chunks(clean_series(data[well_name]))
+        offsets, months = chunk_months(data[well_name],
+                                       first_months.get(well_name))
+        xs[well["split"]].append(chunk_x[well["chunks"]:])
+        ys[well["split"]].append(chunk_y[well["chunks"]:])
+        rows.append((well_name, SPLIT_NAMES.index(well["split"]),
+                     offsets[well["chunks"]:], months[well["chunks"]:]))
+        well["chunks"] = len(chunk_x)
+
+    # Drop index rows past the chunks in the header (interrupted update)
+    indexname = os.path.join(directory, MEMMAP_INDEX_NAME)
+    index = read_index(indexname)
+    if index is not None:
+        for name in SPLIT_NAMES:
+            for part in ("well", "offset", "month"):
+                key = "%s_%s" % (name, part)
+                index[key] = index[key][:header["shapes"][name]["x"][0]]
+
+    # Append chunks and index rows, then write header last
+    datasets = join_chunks([xs[name] for name in SPLIT_NAMES],
+                           [ys[name] for name in SPLIT_NAMES])
+    append_memmap(header, datasets, directory)
+    write_index(build_index(rows, index), indexname)
+    write_header(header, directory)
+    return [len(dataset[0]) for dataset in datasets]
+
+
+def read_blocks(filenames, block_rows=BLOCK_ROWS):
+    """Yields date, well and channel columns of the data files, at most
+       block_rows rows at a time"""
+    names = ("date", "well") + CHANNELS
+    for filename in filenames:
+        with open(filename, "rb") as csvfile:
+            csvfile.readline()
+            while True:
+                lines = list(itertools.islice(csvfile, block_rows))
+                if not lines:
+                    break
+                yield parse_columns("".join(lines), names, filename)
+
+
+def group_wells(blocks):
+    """Yields (well name, first month, calendar series) for each well of a
+       stream of column blocks; rows of a well must be contiguous in the data
+       files"""
+    well_name = None
+    parts = []
+    seen = set()
+    for columns in blocks:
+        # Find the runs of rows of the same well in the block
+        wells = columns["well"]
+        values = channel_values(columns)
+        bounds = np.append(np.flatnonzero(wells[1:] != wells[:-1]) + 1,
+                           len(wells))
+        start = 0
+        for end in bounds:
+            # A new well starts, so the previous one is complete
+            if wells[start] != well_name:
+                if well_name is not None:
+                    yield (well_name,) + join_parts(parts)
+                well_name = wells[start]
+                parts = []
+                if well_name in seen:
+                    raise ValueError("Rows of well %s are not contiguous"
+                                     % well_name)
+                seen.add(well_name)
+            parts.append((columns["date"][start:end], values[start:end]))
+            start = end
+    if well_name is not None:
+        yield (well_name,) + join_parts(parts)
+
+
+def join_parts(parts):
+    """Returns the (months, values) parts of a well as its first month and
+       calendar series"""
+    months, values = zip(*parts)
+    months = np.concatenate(months)
+    return int(months.min()), align_months(months, np.concatenate(values))
+
+
+def clean_wells(wells):
+    """Yields (well name, series, months) with preprocessing applied and the
+       calendar month of each month of the series"""
+    for well_name, first_month, values in wells:
+        yield (well_name, clean_series(values),
+               series_months(values, first_month))
+
+
+def window_wells(wells):
+    """Yields (well name, x, y, offsets, months) holding all (normalized)
+       chunks of a well and their start offsets and months"""
+    for well_name, series, months in wells:
+        chunk_x, chunk_y = make_chunks(series)
+        offsets = chunk_starts(series)
+        yield well_name, chunk_x, chunk_y, offsets, months[offsets]
+
+
+def hash_split(well_name):
+    """Returns the dataset of a well from a hash of its name and the seed,
+       assigning wells in a 6:1:1 ratio without knowing all of them"""
+    digest = hashlib.md5("%d:%s" % (SEED, well_name)).digest()
+    return well_split(ord(digest[0]) % 8, 8)
+
+
+def route_wells(chunks):
+    """Yields (well name, dataset, x, y, offsets, months) with the dataset of
+       each well (by site when DIFFERENT_SITES is set)"""
+    unlisted = set()
+    for well_name, chunk_x, chunk_y, offsets, months in chunks:
+        if DIFFERENT_SITES:
+            split = site_splits([well_name])[0]
+        else:
+            split = hash_split(well_name)
+        if split >= 0:
+            yield well_name, split, chunk_x, chunk_y, offsets, months
+        elif well_name[:SITE_LENGTH] not in unlisted:
+            unlisted.add(well_name[:SITE_LENGTH])
+            print "Error: site %s not classified" % well_name[:SITE_LENGTH]
+
+
+def stream_memmap(filenames, directory=MEMMAP_DIRECTORY,
+                  flush_chunks=FLUSH_CHUNKS):
+    """Writes the memory-mapped dataset one well at a time, so memory use is
+       bounded by a block of rows plus the largest well"""
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    header = new_header()
+
+    # Chain the stages: read rows, group by well, clean, window, route
+    wells = group_wells(read_blocks(filenames))
+    routed = route_wells(window_wells(clean_wells(wells)))
+
+    # Buffer chunks per dataset and append them to disk every so often
+    xs = ([], [], [])
+    ys = ([], [], [])
+    rows = []
+    buffered = 0
+    for well_name, split, chunk_x, chunk_y, offsets, months in routed:
+        header["wells"][well_name] = {"split": SPLIT_NAMES[split],
+                                      "chunks": len(chunk_x)}
+        rows.append((well_name, split, offsets, months))
+        xs[split].append(chunk_x)
+        ys[split].append(chunk_y)
+        buffered += len(chunk_x)
+        if buffered >= flush_chunks:
+            append_memmap(header, join_chunks(xs, ys), directory)
+            xs = ([], [], [])
+            ys = ([], [], [])
+            buffered = 0
+    append_memmap(header, join_chunks(xs, ys), directory)
+    write_index(build_index(rows), os.path.join(directory, MEMMAP_INDEX_NAME))
+
+    # Write header last so readers never see a header without its arrays
+    write_header(header, directory)
+    return header
+
+
+def make_store(data, well_names, first_months=None):
+    """Returns (x, y, wells, months) holding the chunks of all wells in order,
+       made in a single pass, with the well code (position in well_names) and
+       start month of every chunk"""
+    xs, ys, wells, months = [], [], [], []
+    first_months = first_months or {}
+    for code, well_name in enumerate(well_names):
+        chunk_x, chunk_y = make_chunks(clean_series(data[well_name]))
+        xs.append(chunk_x)
+        ys.append(chunk_y)
+        wells.append(np.repeat(np.int32(code), len(chunk_x)))
+        months.append(chunk_months(data[well_name],
+                                   first_months.get(well_name))[1])
+    x, y = join_chunks([xs], [ys])[0]
+    return (x, y, np.concatenate([np.empty(0, np.int32)] + wells),
+            np.concatenate([np.empty(0, np.int32)] + months))
+
+
+def kfold_splits(wells, well_count, folds=CV_FOLDS):
+    """Returns list of (name, train, valid, test) rows of K well-grouped folds:
+       wells are dealt into K groups in order, fold k tests on group k,
+       validates on the group before it and trains on the rest (with 8 folds,
+       the last fold is the usual 6:1:1 split)"""
+    bounds = [well_count*fold/folds for fold in xrange(1, folds)]
+    groups = np.searchsorted(bounds, wells, side="right")
+    splits = []
+    for fold in xrange(folds):
+        test = groups == fold
+        valid = groups == (fold - 1) % folds
+        splits.append(("kfold%d" % fold, np.flatnonzero(~(test | valid)),
+                       np.flatnonzero(valid), np.flatnonzero(test)))
+    return splits
+
+
+def rolling_splits(months, origins=ROLLING_ORIGINS,
+                   step_months=ROLLING_STEP_MONTHS):
+    """Returns list of (name, train, valid, test) rows of rolling-origin folds:
+       for each origin, chunks ending before it are used for training (the
+       latest step_months of them for validation) and chunks whose output
+       starts in the step_months from the origin for testing"""
+    if len(months) and months.min() < 0:
+        raise ValueError("Rolling-origin folds need chunk months (use "
+                         "COLUMNAR_READER)")
+    ends = months + IN_MONTHS + OUT_MONTHS
+    outputs = months + IN_MONTHS
+    last = ends.max() if len(ends) else 0
+    splits = []
+    for fold in xrange(origins):
+        origin = last - (origins - fold)*step_months
+        valid = (ends > origin - step_months) & (ends <= origin)
+        test = (outputs >= origin) & (outputs < origin + step_months)
+        splits.append(("rolling%d" % fold,
+                       np.flatnonzero(ends <= origin - step_months),
+                       np.flatnonzero(valid), np.flatnonzero(test)))
+    return splits
+
+
+def write_cv(data, well_names, directory=CV_DIRECTORY, first_months=None):
+    """Writes the chunks of all wells once (raw float32 arrays) along with the
+       row indices of the K-fold and rolling-origin folds; returns the header"""
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    # Window every well once, then derive all folds from the chunk rows
+    x, y, wells, months = make_store(data, well_names, first_months)
+    splits = kfold_splits(wells, len(well_names))
+    if len(months) == 0 or months.min() >= 0:
+        splits += rolling_splits(months)
+
+    # Chunks are stored once, folds only as row indices into them
+    x.tofile(os.path.join(directory, "x.bin"))
+    y.tofile(os.path.join(directory, "y.bin"))
+    folds = {"wells": np.array(well_names, dtype=str), "well": wells,
+             "month": months}
+    for name, train, valid, test in splits:
+        for split, rows in zip(SPLIT_NAMES, (train, valid, test)):
+            folds["%s_%s" % (name, split)] = rows
+    np.savez(os.path.join(directory, "folds.npz"), **folds)
+
+    # Write header last so readers never see a header without its arrays
+    header = {"dtype": "float32", "params": generation_params(),
+              "shapes": {"x": list(x.shape), "y": list(y.shape)},
+              "folds": [split[0] for split in splits],
+              "fold_params": {"folds": CV_FOLDS, "origins": ROLLING_ORIGINS,
+                              "step_months": ROLLING_STEP_MONTHS}}
+    write_header(header, directory)
+    return header
+
+
+def decimate(values, points=PLOT_POINTS):
+    """Returns indices of the points of a series to plot: the first and last
+       point and the minimum and maximum of each of about points/2 buckets"""
+    count = len(values)
+    if count <= points:
+        return np.arange(count)
+
+    # Pad to equal buckets so the extremes are found with one reduction each
+    size = -(-count//(points//2))
+    buckets = -(-count//size)
+    padded = np.empty(buckets*size, dtype=np.float64)
+    padded[count:] = np.inf
+    padded[:count] = values
+    low = padded.reshape(buckets, size).argmin(axis=1)
+    padded[count:] = -np.inf
+    high = padded.reshape(buckets, size).argmax(axis=1)
+    offsets = size*np.arange(buckets)
+    return np.unique(np.concatenate([[0, count - 1], offsets + low,
+                                     offsets + high]))
+
+
 def plot_chunks(datasets):
     """Plots the datasets' chunks using pyplot"""
     for dataset in datasets:
@@ -134,12 +1059,14 @@ def plot_chunks(datasets):
             plt.ylabel("Production", fontsize=15)
             
             # Plot the predictions as a green line with round markers
-            prediction = np.append(chunk[0], chunk[1])
-            graph.plot(prediction, "g-o", label="Prediction")
+            past = chunk[0].reshape(len(chunk[0]), -1)[:, 0]
+            prediction = np.append(past, chunk[1])
+            points = decimate(prediction)
+            graph.plot(points, prediction[points], "g-o", label="Prediction")
     
-            # Plot the past as a red line with round markers
-            past = chunk[0]
-            graph.plot(past, "r-o", label="Past")
+            # Plot the past (oil) as a red line with round markers
+            points = decimate(past)
+            graph.plot(points, past[points], "r-o", label="Past")
     
             # Add legend and display plot
             plt.legend(loc="upper left")
@@ -151,13 +1078,49 @@ def plot_chunks(datasets):
 
 if __name__ == '__main__':
     rnd.seed(SEED)
-    print "Getting data..."
-    data = get_data()
-    print "Preprocessing data..."
-    datasets = preprocess_data(data)
-    print "Writing datasets to qri.pkl.gz..."
-    with gzip.open("qri.pkl.gz", "wb") as file:
-        file.write(cPickle.dumps(datasets))
-    print "Done!"
-    print "Plotting chunks..."
-    plot_chunks(datasets)
+    if STREAMING:
+        print "Streaming datasets to %s/..." % MEMMAP_DIRECTORY
+        header = stream_memmap(data_filenames())
+        print "Dataset sizes (train, valid, test): %d, %d, %d" % tuple(
+            header["shapes"][name]["x"][0] for name in SPLIT_NAMES)
+        print "Done!"
+    elif INCREMENTAL_UPDATE:
+        print "Getting data..."
+        first_months = {}
+        data = (get_data_columnar(first_months=first_months)
+                if COLUMNAR_READER else get_data())
+        print "Appending new chunks to %s/..." % MEMMAP_DIRECTORY
+        added = update_memmap(data, first_months=first_months)
+        print "Added chunks (train, valid, test): %d, %d, %d" % tuple(added)
+        print "Done!"
+    else:
+        print "Getting data..."
+        first_months = {}
+        data = (get_data_columnar(first_months=first_months)
+                if COLUMNAR_READER else get_data())
+        print "Preprocessing data..."
+        well_names = shuffle_wells(data)
+        datasets = preprocess_data(data, well_names)
+        print "Writing datasets to qri.pkl.gz..."
+        with gzip.open("qri.pkl.gz", "wb") as file:
+            file.write(cPickle.dumps(datasets))
+        print "Writing chunk index to %s..." % INDEX_FILENAME
+        write_index(make_index(data, well_names, first_months))
+        if MEMMAP_DATASET:
+            print "Writing memory-mapped datasets to %s/..." % MEMMAP_DIRECTORY
+            if os.path.isdir(MEMMAP_DIRECTORY):
+                shutil.rmtree(MEMMAP_DIRECTORY)
+            update_memmap(data, well_names=well_names,
+                          first_months=first_months)
+        if WINDOWED_DATASET:
+            print "Writing windowed datasets to qri_windows.pkl.gz..."
+            with gzip.open("qri_windows.pkl.gz", "wb") as file:
+                file.write(cPickle.dumps(preprocess_windows(data, well_names),
+                                         cPickle.HIGHEST_PROTOCOL))
+        if CV_DATASET:
+            print "Writing cross-validation folds to %s/..." % CV_DIRECTORY
+            header = write_cv(data, well_names, first_months=first_months)
+            print "Folds: %s" % ", ".join(header["folds"])
+        print "Done!"
+        print "Plotting chunks..."
+        plot_chunks(datasets)
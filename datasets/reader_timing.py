@@ -0,0 +1,63 @@
+"""Compares the timing of the row-by-row and columnar CSV readers"""
+
+import multiprocessing
+import time
+import numpy as np
+import dataset_gen
+
+# Number of times each reader is run
+REPEATS = 3
+
+# Number of processes for the parallel columnar reader
+WORKERS = multiprocessing.cpu_count()
+
+
+def time_reader(reader):
+    """Returns the best time of several runs of reader and its output"""
+    best = float("inf")
+    for _ in xrange(REPEATS):
+        t0 = time.time()
+        data = reader()
+        best = min(best, time.time() - t0)
+    return best, data
+
+
+if __name__ == '__main__':
+    # Time the parsers themselves, without the cache of parsed columns
+    cache_directory = dataset_gen.CACHE_DIRECTORY
+    dataset_gen.CACHE_DIRECTORY = None
+    print "Timing csv.reader (get_data)..."
+    row_time, row_data = time_reader(dataset_gen.get_data)
+    print "Timing columnar reader (get_data_columnar)..."
+    col_time, col_data = time_reader(lambda: dataset_gen.get_data_columnar(1))
+    print "Timing parallel columnar reader (%d workers)..." % WORKERS
+    par_time, par_data = time_reader(
+        lambda: dataset_gen.get_data_columnar(WORKERS))
+
+    # Time reads from the cache once it has been filled
+    cache_time = None
+    if cache_directory is not None:
+        dataset_gen.CACHE_DIRECTORY = cache_directory
+        print "Timing cached columnar reader..."
+        dataset_gen.get_data_columnar(1)
+        cache_time, cache_data = time_reader(
+            lambda: dataset_gen.get_data_columnar(1))
+
+    # Check that the readers agree (up to float32 precision for csv.reader)
+    assert sorted(row_data.keys()) == sorted(col_data.keys())
+    assert sorted(col_data.keys()) == sorted(par_data.keys())
+    for well_name in row_data:
+        assert np.allclose(row_data[well_name], col_data[well_name])
+        assert np.array_equal(col_data[well_name], par_data[well_name])
+        if cache_time is not None:
+            assert np.array_equal(col_data[well_name], cache_data[well_name])
+
+    print "Wells: %d" % len(row_data)
+    print "csv.reader: %f s" % row_time
+    print "Columnar: %f s" % col_time
+    print "Parallel columnar: %f s" % par_time
+    print "Speedup: %.1fx (parallel %.1fx)" % (row_time/col_time,
+                                              row_time/par_time)
+    if cache_time is not None:
+        print "Cached columnar: %f s (%.1fx)" % (cache_time,
+                                                row_time/cache_time)
@@ -1,78 +1,191 @@
 """Viewer for the QRI data"""
 
-import csv
+import matplotlib
+import multiprocessing
+import os
+import warnings
+
+# Render every well to an image file with a pool of processes instead of
+# showing one window per well
+BATCH_MODE = False
+BATCH_WORKERS = multiprocessing.cpu_count()
+OUTPUT_DIRECTORY = "well_plots"
+OUTPUT_FORMAT = "png"
+
+# Also plot a summary of each site (all of its wells) before the wells
+SITE_SUMMARY = False
+
+# Batch mode needs a non-interactive backend (chosen before pyplot is loaded)
+if BATCH_MODE:
+	matplotlib.use("Agg")
+
 import matplotlib.pyplot as plt
 import numpy as np
-import os
+import dataset_gen
 from datetime import datetime
 from matplotlib.dates import date2num, num2date
 
-# Data is contained in this dictionary
-# Keys are the oil well names
-# Values are lists containing two lists that contain the dates/oil measurements
-data = {}
-
-# Data files are located in data directory
-os.chdir("../data")
-
-for filename in os.listdir(os.getcwd()):
-	with open(filename, "rb") as csvfile:
-		# Open each data file with csv reader
-	    reader = csv.reader(csvfile, dialect="excel")
-	    
-	    # Ignore the first line because it contains headers
-	    reader.next()
-	    
-	    # Add each row to the current oil well
-	    for row in reader:
-	    	# Get data from cells and convert appropriately
-	    	date = date2num(datetime.strptime(row[0],"%m/%d/%Y"))
-	    	name = row[3]
-	    	oil = float(row[4])
-	    	
-	    	# Add data to the dictionary
-	    	if not name in data:
-	    		data[name] = [[], []]
-	        data[name][0].append(date)
-	        data[name][1].append(oil)
-
-for name in data:
-	# Get data from dictionary
-	dates = data[name][0]
-	oils = data[name][1]
-	
-	# Create a figure and add a subplot with labels
-	fig = plt.figure(1)
+# Figure reused for every plot drawn by this process
+figure = None
+
+
+def month_dates(months):
+	"""Returns matplotlib dates (first day of each month) of month indices"""
+	months = (np.asarray(months) - 1970*12).astype("datetime64[M]")
+	days = months.astype("datetime64[D]").astype(int)
+	return date2num(datetime(1970, 1, 1)) + days
+
+
+def read_columns():
+	"""Returns date, well and oil columns of the data files (cached columns
+	   are reused if the files are unchanged)"""
+	return dataset_gen.read_data_columns(("date", "well", "oil"))
+
+
+def get_wells(columns):
+	"""Returns dictionary mapping well names to (dates, oils) arrays"""
+	# Convert month indices to dates in bulk
+	rows = np.column_stack([month_dates(columns["date"]), columns["oil"]])
+
+	# Split the rows of each oil well into dates and oil measurements
+	return dict((name, (well_rows[:, 0], well_rows[:, 1])) for name, well_rows
+				in dataset_gen.group_by_well(columns["well"], rows).items())
+
+
+def get_sites(columns):
+	"""Returns dictionary mapping site names to aggregates of the production
+	   of their wells per calendar month: dates, total, producing wells and
+	   10th/50th/90th percentiles over the producing wells"""
+	# Production of every well on a common calendar (wells x months)
+	first = columns["date"].min()
+	wells, codes = np.unique(columns["well"], return_inverse=True)
+	production = np.zeros((len(wells), columns["date"].max() - first + 1))
+	np.add.at(production, (codes, columns["date"] - first), columns["oil"])
+	dates = month_dates(first + np.arange(production.shape[1]))
+
+	# Aggregate the wells of each site over months with production
+	sites = wells.astype("S%d" % dataset_gen.SITE_LENGTH)
+	aggregates = {}
+	for site in np.unique(sites):
+		site_production = production[sites == site]
+		producing = (site_production > 0).sum(axis=0)
+		bands = np.empty((3, len(dates)))
+		bands.fill(np.nan)
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore", RuntimeWarning)
+			bands[:, producing > 0] = np.nanpercentile(
+				np.where(site_production > 0, site_production, np.nan)[
+					:, producing > 0], [10, 50, 90], axis=0)
+		aggregates[site] = {"dates": dates, "wells": producing,
+							"total": site_production.sum(axis=0),
+							"bands": bands, "count": len(site_production)}
+	return aggregates
+
+
+def draw_well(fig, name, dates, oils):
+	"""Draws the oil production of a well on a (cleared) figure"""
+	# Add a subplot with labels
+	fig.clf()
 	graph = fig.add_subplot(111)
 	fig.suptitle(name, fontsize=25)
 	# plt.xlabel("Date", fontsize=15)
-	plt.xlabel("Index", fontsize=15) #INDEX!!!!!
-	plt.ylabel("Production (barrels)", fontsize=15)
-	
+	graph.set_xlabel("Index", fontsize=15) #INDEX!!!!!
+	graph.set_ylabel("Production (barrels)", fontsize=15)
+
 	# Set the xtick locations to correspond to the dates every 12 months
 	graph.set_xticks(dates[0::12])
-	 
+
 	# Set the xtick labels to correspond to the dates every 12 months
 	date_labels = [num2date(date).strftime("%m/%y") for date in dates[0::12]]
 	graph.set_xticklabels(date_labels)
-	
+
 	# Remove zeroed data points
-	i = 0
-	while i < len(oils):
-		if oils[i] == 0:
-			del dates[i]
-			del oils[i]
-		else:
-			i += 1
-
-	# Convert data to numpy arrays
-	dates = np.array(dates)
-	oils = np.array(oils)
-	
-	# Plot the raw data as a red line with round markers
-	#graph.plot(dates, oils, "r-o", label="Oil Production")
-	graph.plot(oils, "r-o", label="Oil Production")
-	
-	# Add legend and display plot
-	plt.legend()
-	plt.show()
+	nonzero = oils != 0
+	dates = dates[nonzero]
+	oils = oils[nonzero]
+
+	# Plot the raw data (decimated if long) as a red line with round markers
+	points = dataset_gen.decimate(oils)
+	#graph.plot(dates[points], oils[points], "r-o", label="Oil Production")
+	graph.plot(points, oils[points], "r-o", label="Oil Production")
+
+	# Add legend
+	graph.legend()
+
+
+def draw_site(fig, name, aggregate):
+	"""Draws the aggregated production of a site on a (cleared) figure"""
+	# Add a subplot with labels
+	fig.clf()
+	graph = fig.add_subplot(111)
+	fig.suptitle("%s (%d wells)" % (name, aggregate["count"]), fontsize=25)
+	graph.set_xlabel("Date", fontsize=15)
+	graph.set_ylabel("Production per well (barrels)", fontsize=15)
+
+	# Keep the extremes of every line when decimating
+	dates = aggregate["dates"]
+	low, median, high = aggregate["bands"]
+	total = aggregate["total"]
+	points = reduce(np.union1d, [dataset_gen.decimate(np.nan_to_num(line))
+								 for line in (low, median, high, total)])
+
+	# Plot the spread and median of the wells in red
+	graph.fill_between(dates[points], low[points], high[points], color="r",
+					   alpha=0.2, label="10th-90th percentile")
+	graph.plot(dates[points], median[points], "r-", label="Median well")
+	graph.xaxis_date()
+	graph.legend(loc="upper left")
+
+	# Plot the site total in blue on its own axis
+	totals = graph.twinx()
+	totals.set_ylabel("Site production (barrels)", fontsize=15)
+	totals.plot(dates[points], total[points], "b-", label="Site total")
+	totals.legend(loc="upper right")
+
+
+def render(item):
+	"""Draws a plot on this process's figure and saves it to the output
+	   directory; item is (file name, draw function, arguments); returns the
+	   filename"""
+	global figure
+	if figure is None:
+		figure = plt.figure(1)
+	name, draw, args = item
+	draw(figure, *args)
+	filename = os.path.join(OUTPUT_DIRECTORY, "%s.%s" % (name, OUTPUT_FORMAT))
+	figure.savefig(filename, format=OUTPUT_FORMAT)
+	return filename
+
+
+def render_all(items, workers=BATCH_WORKERS):
+	"""Saves every plot using a pool of processes; returns the filenames"""
+	if not os.path.isdir(OUTPUT_DIRECTORY):
+		os.makedirs(OUTPUT_DIRECTORY)
+	if workers <= 1:
+		return map(render, items)
+	pool = multiprocessing.Pool(workers)
+	try:
+		return pool.map(render, items, chunksize=16)
+	finally:
+		pool.close()
+		pool.join()
+
+
+if __name__ == '__main__':
+	columns = read_columns()
+	wells = get_wells(columns)
+	items = [(name, draw_well, (name,) + wells[name]) for name in sorted(wells)]
+	if SITE_SUMMARY:
+		sites = get_sites(columns)
+		items = [("site_" + name, draw_site, (name, sites[name]))
+				 for name in sorted(sites)] + items
+	if BATCH_MODE:
+		print "Rendering %d plots to %s/..." % (len(items), OUTPUT_DIRECTORY)
+		render_all(items)
+		print "Done!"
+	else:
+		for name, draw, args in items:
+			# Draw the plot and display it
+			fig = plt.figure(1)
+			draw(fig, *args)
+			plt.show()
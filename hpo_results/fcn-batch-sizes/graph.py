@@ -1,17 +1,26 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import sys
 
-batch_sizes = []
-test_error = []
+# Use the results store of the Keras scripts
+directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(directory, "..", "..", "keras"))
+import trialdb
 
-# Get data from files in data directory
-for filename in os.listdir(os.getcwd()):
-    with open(filename) as f:
-        if filename[-4:] == ".out":
-            batch_sizes.append(int(filename[9:-4]))
-            f.readline()
-            test_error.append(float(f.readline()))
+# Results database to plot (by default the .out files of this directory,
+# which are added to hpo_results/trials.db the first time)
+DATABASE = sys.argv[1] if len(sys.argv) > 1 else os.path.join(directory, "..",
+                                                              "trials.db")
+SWEEP = "fcn-batch-sizes"
+
+# Get data from the results database
+if not trialdb.query(DATABASE, SWEEP):
+    trialdb.import_results(DATABASE, SWEEP, directory,
+                           r"fcn-batch(?P<batch_size>\d+)\.out$")
+trials = trialdb.query(DATABASE, SWEEP, status="done")
+batch_sizes = [trial["params"]["batch_size"] for trial in trials]
+test_error = [trial["test_set_loss"] for trial in trials]
 
 # Sort data points
 batch_sizes, test_error = zip(*sorted(zip(batch_sizes, test_error)))
@@ -28,4 +37,4 @@ graph.plot(batch_sizes, test_error, 'r', label="Testing Error")
 
 # Add legend and display plot
 plt.legend()
-plt.show()
\ No newline at end of file
+plt.show()
@@ -3,21 +3,29 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 from mpl_toolkits.mplot3d import Axes3D
 import os
+import sys
 
+# Use the results store of the Keras scripts
+directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(directory, "..", "..", "keras"))
+import trialdb
 
-nlayers = []
-nneurons = []
-time_elapsed = []
-test_error = []
+# Results database to plot (by default the .out files of this directory,
+# which are added to hpo_results/trials.db the first time)
+DATABASE = sys.argv[1] if len(sys.argv) > 1 else os.path.join(directory, "..",
+                                                              "trials.db")
+SWEEP = "fcn-hl"
 
-# Get data from files in data directory
-for filename in os.listdir(os.getcwd()):
-    with open(filename) as f:
-        if filename[-4:] == ".out":
-            nlayers.append(int(filename[6]))
-            nneurons.append(int(filename[19:-4]))
-            time_elapsed.append(float(f.readline()))
-            test_error.append(float(f.readline()))
+# Get data from the results database
+if not trialdb.query(DATABASE, SWEEP):
+    trialdb.import_results(DATABASE, SWEEP, directory,
+                           r"fcn-a-(?P<hidden_layers>\d+)hidden-thick"
+                           r"(?P<neurons>\d+)\.out$")
+trials = trialdb.query(DATABASE, SWEEP, status="done")
+nlayers = [trial["params"]["hidden_layers"] for trial in trials]
+nneurons = [trial["params"]["neurons"] for trial in trials]
+time_elapsed = [trial["time_elapsed"] for trial in trials]
+test_error = [trial["test_set_loss"] for trial in trials]
 
 # Create a figure and add a subplot with labels
 fig = plt.figure()
@@ -31,4 +39,4 @@ graph.set_zlabel("Testing Error")
 graph.plot_trisurf(nneurons, nlayers, test_error, linewidth=0, cmap=cm.coolwarm)
 
 # Display plot
-plt.show()
\ No newline at end of file
+plt.show()
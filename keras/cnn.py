@@ -20,20 +20,22 @@ np.random.seed(42)
 # Load QRI data
 datasets = qri.load_data("../datasets/qri.pkl.gz")
 
-# Split into 3D datasets
-datasets = [(dataset[0][:,:,np.newaxis], dataset[1]) for dataset in datasets]
+# Split into 3D datasets (multi-channel datasets are already 3D)
+datasets = qri.to_3d(datasets)
 train_set, valid_set, test_set = datasets
+n_channels = train_set[0].shape[2]
 
 # Build neural network
 model = Sequential()
-model.add(Convolution1D(1, 100, 13, activation="relu"))
+model.add(Convolution1D(n_channels, 100, 13, activation="relu"))
 model.add(Dropout(0.5))
 model.add(Flatten())
 model.add(Dense(3600, 12))
 
-# Use stochastic gradient descent and compile model
+# Use stochastic gradient descent and compile model (or load it from the
+# compile cache)
 sgd = SGD(lr=0.001, momentum=0.99, decay=1e-6, nesterov=True)
-model.compile(loss=qri.mae_clip, optimizer=sgd)
+model, compile_time = qri.compile_model(model, qri.mae_clip, sgd)
 
 # Use early stopping and saving as callbacks
 early_stop = EarlyStopping(monitor='val_loss', patience=10)
@@ -51,11 +53,13 @@ model.load_weights("models/%s.mdl" % MDL_NAME)
 
 # Print time elapsed and loss on testing dataset
 test_set_loss = model.test_on_batch(test_set[0], test_set[1])
-print "\nTime elapsed: %f s" % time_elapsed
+print "\nCompile time: %f s" % compile_time
+print "Time elapsed: %f s" % time_elapsed
 print "Testing set loss: %f" % test_set_loss
 
 # Save results
-qri.save_results("results/%s.out" % MDL_NAME, time_elapsed, test_set_loss)
+qri.save_results("results/%s.out" % MDL_NAME, time_elapsed, test_set_loss,
+                 compile_time)
 qri.save_history("models/%s.hist" % MDL_NAME, hist.history)
 
 # Plot training and validation loss
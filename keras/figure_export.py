@@ -0,0 +1,103 @@
+"""Export pages of plots headlessly with a pool of worker processes
+
+The caller gives a function that draws one item (e.g. a chunk with its
+prediction) on a subplot and the arrays it is drawn from, one row per item.
+Each worker stores the arrays once and reuses a single Agg figure, drawing
+rows*cols items per page (a contact sheet for grids larger than 1x1), and
+saves every page to its own file. For a single PDF the workers rasterize
+the pages at PDF_DPI dots per inch and the parent places each bitmap on a
+PDF page, so the pages of the PDF are raster images, not vector plots.
+Used by keras/qri.py and by scraps/nnet_lib/nnet1d/nnet1d.py."""
+
+import multiprocessing
+import os
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+
+# Resolution of the pages of a PDF (they are rasterized by the workers)
+PDF_DPI = 100
+
+# Items, drawing function and figure of an export worker
+export_state = {}
+
+
+def init_export(draw, items, grid, title, options):
+    """Stores the drawing function and items to export in a worker and
+       creates the (headless) figure it reuses for every page"""
+    rows, cols = grid
+    figure = Figure(figsize=(8, 6) if grid == (1, 1) else (4*cols, 3*rows))
+    FigureCanvasAgg(figure)
+    export_state.update(draw=draw, items=items, grid=grid, title=title,
+                        options=options, figure=figure)
+
+
+def export_page(page):
+    """Draws a page of items on the worker's figure and saves it (returns
+       the filename) or, for a PDF, returns the page as an RGBA array"""
+    state = export_state
+    figure = state["figure"]
+    rows, cols = state["grid"]
+    start = page*rows*cols
+    stop = min(start + rows*cols, len(state["items"][0]))
+
+    # Draw one item per subplot
+    figure.clf()
+    if (rows, cols) == (1, 1):
+        figure.suptitle(state["title"], fontsize=25)
+    for i in xrange(start, stop):
+        state["draw"](figure.add_subplot(rows, cols, i - start + 1),
+                      *[array[i] for array in state["items"]])
+    if (rows, cols) != (1, 1):
+        figure.tight_layout()
+
+    # Pages of a PDF are returned to the parent, which writes the file
+    options = state["options"]
+    if options["pdf_filename"]:
+        figure.set_dpi(PDF_DPI)
+        image, (width, height) = figure.canvas.print_to_buffer()
+        return np.frombuffer(image, np.uint8).reshape(height, width, 4)
+    name = "%04d" % page if (rows, cols) == (1, 1) else "sheet_%04d" % page
+    filename = "%s/%s.%s" % (options["output_folder"], name,
+                             options["output_format"])
+    figure.savefig(filename, format=options["output_format"])
+    return filename
+
+
+def export_pages(draw, items, title, output_folder="images",
+                 output_format="png", grid=(1, 1), pdf_filename=None,
+                 workers=None):
+    """Saves plots of every item, drawn by draw(subplot, *row) from the rows
+       of the arrays in items, using a pool of processes; grid gives the
+       (rows, cols) of items per page, and pdf_filename writes all pages to
+       a single PDF of raster pages instead of one file per page. Returns
+       the filenames written"""
+    rows, cols = grid
+    pages = xrange(-(-len(items[0])//(rows*cols)))
+    options = {"output_folder": output_folder, "output_format": output_format,
+               "pdf_filename": pdf_filename}
+    if not pdf_filename and not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+
+    # Items are shared with the workers once, pages come back in order
+    pool = multiprocessing.Pool(workers, init_export,
+                                (draw, items, grid, title, options))
+    try:
+        results = pool.imap(export_page, pages, chunksize=8)
+        if not pdf_filename:
+            return list(results)
+
+        # Place every rendered page on a PDF page of the same size
+        with PdfPages(pdf_filename) as pdf:
+            for image in results:
+                height, width = image.shape[:2]
+                page = Figure(figsize=(width/float(PDF_DPI),
+                                       height/float(PDF_DPI)), dpi=PDF_DPI)
+                FigureCanvasAgg(page)
+                page.figimage(image)
+                pdf.savefig(page, dpi=PDF_DPI)
+        return [pdf_filename]
+    finally:
+        pool.close()
+        pool.join()
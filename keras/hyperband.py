@@ -0,0 +1,250 @@
+"""Search a sweep's grid with successive halving (or Hyperband)
+
+Usage: python hyperband.py sweeps/fcn-hl.json
+
+Instead of training every trial of a sweep until early stopping, all trials
+are trained for MIN_EPOCHS epochs, the best 1/ETA of them (by validation
+loss) are trained on to ETA times as many epochs, and so on until the
+survivors reach MAX_EPOCHS, when they are evaluated on the testing dataset.
+Trials continue from the best weights of their previous rung. With
+HYPERBAND, the grid is shuffled and split into brackets that each start at
+a different number of epochs, from many trials trained briefly to a few
+trained for MAX_EPOCHS from the start."""
+
+# Importing sweep first limits the BLAS threads of the workers
+import sweep
+
+import itertools
+import math
+import multiprocessing
+import numpy as np
+import os
+import random
+import sys
+import time
+import traceback
+import qri
+import runner
+import trialdb
+from keras.callbacks import EarlyStopping, ModelCheckpoint
+
+# Epochs of the first rung, epochs of the last rung and the factor by which
+# the number of trials shrinks (and their epochs grow) from rung to rung
+MIN_EPOCHS = 1
+MAX_EPOCHS = 81
+ETA = 3
+
+# Run Hyperband brackets instead of a single successive halving bracket
+# over the whole grid (the first rung of each bracket replaces MIN_EPOCHS)
+HYPERBAND = False
+
+# Number of trials trained at the same time (one process each)
+WORKERS = sweep.WORKERS
+
+# Added to the sweep name under which trials are recorded in the results
+# database and to the names of their model, history and results files, so
+# that a search and a full sweep of the same grid are kept apart
+SWEEP_SUFFIX = "-hyperband"
+
+
+def make_state(params, spec):
+    """Return the training state of a trial that has not been trained"""
+    return {"name": spec["name"], "params": params, "spec": spec,
+            "bracket": 0, "epochs": 0, "loss": float("inf"),
+            "stopped": False, "failed": False, "time_elapsed": 0.,
+            "compile_time": 0., "history": {}}
+
+
+def train_rung(trial, epochs, final):
+    """Train a trial until it has been trained for epochs epochs (or stops
+       early), continuing from its best weights; the final rung also
+       evaluates it on the testing dataset and saves its results and
+       history; return the new state of the trial"""
+    trial = dict(trial)
+    spec = trial["spec"]
+    name = trial["name"]
+    np.random.seed(spec["seed"])
+    train_set, valid_set, test_set = runner.get_datasets(spec)
+    model, compile_time = runner.build_model(spec, train_set)
+    trial["compile_time"] += compile_time
+    filename = "models/%s%s.mdl" % (name, SWEEP_SUFFIX)
+    if trial["epochs"]:
+        model.load_weights(filename)
+
+    # Train on from the best validation loss so far (trials that stopped
+    # early in a previous rung are not trained again)
+    if not trial["stopped"] and epochs > trial["epochs"]:
+        early_stop = EarlyStopping(monitor="val_loss",
+                                   patience=spec["patience"])
+        save_best = ModelCheckpoint(filename, save_best_only=True)
+        early_stop.best = save_best.best = trial["loss"]
+        t0 = time.time()
+        hist = model.fit(train_set[0], train_set[1],
+                         validation_data=valid_set, verbose=spec["verbose"],
+                         callbacks=[early_stop, save_best],
+                         nb_epoch=epochs - trial["epochs"],
+                         batch_size=spec["batch_size"])
+        trial["time_elapsed"] += time.time() - t0
+
+        # Add the rung to the trial's history
+        trained = len(hist.history["val_loss"])
+        trial["stopped"] = trained < epochs - trial["epochs"]
+        trial["epochs"] += trained
+        trial["loss"] = min([trial["loss"]] + hist.history["val_loss"])
+        trial["history"] = dict((key, trial["history"].get(key, []) + values)
+                                for key, values in hist.history.items())
+
+    # Load the best weights and evaluate them on the testing dataset
+    if final:
+        model.load_weights(filename)
+        test_set_loss = model.test_on_batch(test_set[0], test_set[1])
+        trial["test_set_loss"] = float(test_set_loss)
+        print "\n%s - Epochs: %d" % (name, trial["epochs"])
+        print "%s - Time elapsed: %f s" % (name, trial["time_elapsed"])
+        print "%s - Testing set loss: %f" % (name, test_set_loss)
+        qri.save_results("results/%s%s.out" % (name, SWEEP_SUFFIX),
+                         trial["time_elapsed"], test_set_loss,
+                         trial["compile_time"])
+        qri.save_history("models/%s%s.hist" % (name, SWEEP_SUFFIX),
+                         trial["history"])
+
+    # Record the trial after every rung (it is done after the last one)
+    if runner.RESULTS_DATABASE is not None:
+        trialdb.save_trial(runner.RESULTS_DATABASE, dict(
+            trial, sweep=spec["sweep"] + SWEEP_SUFFIX,
+            valid_loss=trial["loss"],
+            status="done" if final else "trained"))
+    return trial
+
+
+def run_task(task):
+    """Train a trial for a rung; a trial that fails is marked as failed"""
+    trial, epochs, final = task
+    try:
+        return train_rung(trial, epochs, final)
+    except Exception:
+        print "%s - Failed:\n%s" % (trial["name"], traceback.format_exc())
+        return dict(trial, failed=True)
+
+
+def run_rung(pool, trials, epochs, final, log):
+    """Train trials for a rung in the pool (or in this process if pool is
+       None), logging each trial as it finishes; return the new states of
+       the trials that did not fail"""
+    tasks = [(trial, epochs, final) for trial in trials]
+    if pool is None:
+        finished = itertools.imap(run_task, tasks)
+    else:
+        finished = pool.imap_unordered(run_task, tasks, chunksize=1)
+    results = []
+    for trial in finished:
+        log(trial)
+        if not trial["failed"]:
+            results.append(trial)
+    return results
+
+
+def successive_halving(pool, trials, min_epochs, max_epochs, eta, log):
+    """Train trials in rungs from min_epochs to max_epochs epochs, keeping
+       the best 1/eta of them after every rung; return the states of the
+       trials of the last rung"""
+    epochs = min(min_epochs, max_epochs)
+    while True:
+        final = epochs >= max_epochs
+        print "\nRung of %d epochs: %d trials" % (epochs, len(trials))
+        trials = run_rung(pool, trials, epochs, final, log)
+        if final or not trials:
+            return trials
+
+        # Promote the trials with the lowest validation loss
+        trials.sort(key=lambda trial: trial["loss"])
+        trials = trials[:max(1, len(trials)//eta)]
+        epochs = min(epochs*eta, max_epochs)
+
+
+def hyperband(pool, trials, max_epochs, eta, seed, log):
+    """Run the Hyperband brackets on trials drawn at random from the grid
+       (each trial is in at most one bracket); return the states of the
+       trials of the last rung of every bracket"""
+    brackets = int(math.log(max_epochs)/math.log(eta) + 1e-9)
+    trials = list(trials)
+    random.Random(seed).shuffle(trials)
+    survivors = []
+    for bracket in range(brackets, -1, -1):
+        # Bracket s starts n trials at max_epochs/eta^s epochs
+        count = int(math.ceil((brackets + 1.)/(bracket + 1)*eta**bracket))
+        started, trials = trials[:count], trials[count:]
+        if not started:
+            break
+        for trial in started:
+            trial["bracket"] = bracket
+        min_epochs = max(1, int(round(max_epochs/float(eta**bracket))))
+        print "\nBracket %d: %d trials" % (bracket, len(started))
+        survivors += successive_halving(pool, started, min_epochs,
+                                        max_epochs, eta, log)
+    return survivors
+
+
+def run_search(sweep_def, workers=WORKERS, filename=runner.DATA_FILENAME):
+    """Search the grid of a sweep, appending the state of every trial to
+       the sweep's rungs file after each rung; return the states of the
+       fully trained trials"""
+    trials = [make_state(params, spec)
+              for params, spec in sweep.make_trials(sweep_def)]
+    names = sorted(sweep_def["grid"])
+    if not os.path.isdir(sweep.RESULTS_DIRECTORY):
+        os.makedirs(sweep.RESULTS_DIRECTORY)
+    rungs_filename = os.path.join(sweep.RESULTS_DIRECTORY,
+                                  "%s.rungs" % sweep_def["sweep"])
+
+    # Workers started by fork share the parent's datasets
+    runner.init_worker(filename)
+    pool = None
+    if workers > 1 and len(trials) > 1:
+        pool = multiprocessing.Pool(min(workers, len(trials)),
+                                    runner.init_worker, (filename,))
+
+    # Write a tab-separated line per trial and rung in the order they finish
+    try:
+        with open(rungs_filename, "w") as file:
+            file.write("\t".join(["name"] + names +
+                                 ["bracket", "epochs", "valid_loss",
+                                  "stopped", "failed"]) + "\n")
+
+            def log(trial):
+                values = [str(trial["params"][param]) for param in names]
+                file.write("\t".join([trial["name"]] + values +
+                                     ["%d" % trial["bracket"],
+                                      "%d" % trial["epochs"],
+                                      "%f" % trial["loss"],
+                                      "%d" % trial["stopped"],
+                                      "%d" % trial["failed"]]) + "\n")
+                file.flush()
+
+            if HYPERBAND:
+                return hyperband(pool, trials, MAX_EPOCHS, ETA,
+                                 runner.DEFAULT_SPEC["seed"], log)
+            return successive_halving(pool, trials, MIN_EPOCHS, MAX_EPOCHS,
+                                      ETA, log)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    for filename in sys.argv[1:]:
+        sweep_def = sweep.load_sweep(filename)
+        t0 = time.time()
+        survivors = run_search(sweep_def)
+
+        # Print the fully trained trials of the search
+        survivors.sort(key=lambda trial: trial["test_set_loss"])
+        print "\n%s: %d trials fully trained (%f s)" % (
+            sweep_def["sweep"], len(survivors), time.time() - t0)
+        print "%-32s %8s %14s %14s" % ("Model", "Epochs", "Valid loss",
+                                       "Test loss")
+        for trial in survivors:
+            print "%-32s %8d %14f %14f" % (trial["name"], trial["epochs"],
+                                           trial["loss"],
+                                           trial["test_set_loss"])
@@ -0,0 +1,143 @@
+"""Pack the trials of a sweep into array jobs and run them
+
+Usage: python jobs.py pack sweeps/fcn-hl.json  (writes jobs/fcn-hl/)
+       sbatch jobs/fcn-hl/submit.sh            (runs the jobs with SLURM)
+       python jobs.py local jobs/fcn-hl        (runs them on this machine)
+       python jobs.py run jobs/fcn-hl 3        (runs job 3, as SLURM does)
+
+Packing splits the trials of a sweep file into job files of at most
+TRIALS_PER_JOB trials each and writes a SLURM array script with one array
+task per job file. Each job runs all of its trials in one process, so
+Python and Theano start and the dataset is loaded once per job instead of
+once per trial. The local stand-in runs the same job files with a pool of
+WORKERS processes. Trials that are done are skipped and interrupted trials
+continue from their last checkpoint, so a job can simply be run again."""
+
+# Importing sweep first limits the BLAS threads of the workers
+import sweep
+
+import glob
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+import runner
+
+# Directory the job files of each sweep are written to (<sweep>/job_<i>)
+JOBS_DIRECTORY = "jobs"
+
+# Largest number of trials run by one job
+TRIALS_PER_JOB = 10
+
+# Options of the array script (see cluster/scriptgpu.sh), whether the jobs
+# use a GPU and how many array tasks may run at once (None for no limit)
+SBATCH_OPTIONS = ["-n 1", "-N 1", "-t 0-60:00", "-p holyseasgpu",
+                  "--mem=1000"]
+GPU = True
+MAX_RUNNING_JOBS = None
+
+# Number of jobs run at the same time by the local stand-in
+WORKERS = sweep.WORKERS
+
+
+def pack_sweep(sweep_def, trials_per_job=TRIALS_PER_JOB,
+               directory=JOBS_DIRECTORY):
+    """Write the job files and array script of a sweep; return the name of
+       the job directory"""
+    trials = sweep.make_trials(sweep_def)
+    jobs = max(1, int(math.ceil(len(trials)/float(trials_per_job))))
+    job_directory = os.path.join(directory, sweep_def["sweep"])
+    if not os.path.isdir(job_directory):
+        os.makedirs(job_directory)
+    for filename in glob.glob(os.path.join(job_directory, "job_*.json")):
+        os.remove(filename)
+
+    # Deal the trials out in turn so that every job gets a similar mix of
+    # small and large models
+    for job in range(jobs):
+        names = [spec["name"] for params, spec in trials[job::jobs]]
+        with open(os.path.join(job_directory, "job_%d.json" % job),
+                  "w") as file:
+            json.dump({"sweep": sweep_def, "trials": names}, file, indent=1)
+
+    # Write an array script with one task per job
+    array = "0-%d" % (jobs - 1)
+    if MAX_RUNNING_JOBS is not None:
+        array += "%%%d" % MAX_RUNNING_JOBS
+    options = SBATCH_OPTIONS + [
+        "--array=%s" % array,
+        "-o %s" % os.path.join(job_directory, "job_%a.out"),
+        "-e %s" % os.path.join(job_directory, "job_%a.err")]
+    command = "python jobs.py run %s $SLURM_ARRAY_TASK_ID" % job_directory
+    if GPU:
+        options.append("--gres=gpu:1")
+        command = ("THEANO_FLAGS=mode=FAST_RUN,device=gpu,floatX=float32 " +
+                   command)
+    with open(os.path.join(job_directory, "submit.sh"), "w") as file:
+        file.write("#!/bin/bash\n\n")
+        file.write("".join("#SBATCH %s\n" % option for option in options))
+        file.write("\n%s\n" % command)
+    print "Packed %d trials of %s into %d jobs in %s/" % (
+        len(trials), sweep_def["sweep"], jobs, job_directory)
+    return job_directory
+
+
+def run_job(job_filename, workers=1, filename=runner.DATA_FILENAME):
+    """Run the trials of a job file that are not done yet, one after
+       another in this process (or in a pool of workers); return their
+       results"""
+    with open(job_filename) as file:
+        job = json.load(file)
+    names = set(job["trials"])
+    trials = [(params, spec) for params, spec
+              in sweep.make_trials(job["sweep"]) if spec["name"] in names]
+
+    # Results of each job go to their own file, as jobs run at the same time
+    results_name = "%s-%s" % (job["sweep"]["sweep"], os.path.splitext(
+        os.path.basename(job_filename))[0])
+    return sweep.run_sweep(job["sweep"], workers, filename, trials,
+                           results_name)
+
+
+def job_filenames(job_directory):
+    """Return the job files of a job directory in job order"""
+    return sorted(glob.glob(os.path.join(job_directory, "job_*.json")),
+                  key=lambda filename: int(filename.split("_")[-1][:-5]))
+
+
+def run_local(job_directory, workers=WORKERS, filename=runner.DATA_FILENAME):
+    """Run every job of a job directory on this machine, WORKERS jobs at a
+       time like array tasks; return the results of all their trials"""
+    jobs = job_filenames(job_directory)
+
+    # Workers started by fork share the parent's datasets
+    runner.init_worker(filename)
+    if workers <= 1 or len(jobs) <= 1:
+        return sum(map(run_job, jobs), [])
+    pool = multiprocessing.Pool(min(workers, len(jobs)), runner.init_worker,
+                                (filename,), maxtasksperchild=1)
+    try:
+        return sum(pool.map(run_job, jobs, chunksize=1), [])
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    t0 = time.time()
+    if sys.argv[1] == "pack":
+        for filename in sys.argv[2:]:
+            pack_sweep(sweep.load_sweep(filename))
+    elif sys.argv[1] == "run":
+        results = run_job(os.path.join(sys.argv[2],
+                                       "job_%d.json" % int(sys.argv[3])))
+    elif sys.argv[1] == "local":
+        results = run_local(sys.argv[2])
+    else:
+        raise ValueError("Unknown command %s" % sys.argv[1])
+    if sys.argv[1] != "pack":
+        print "\n%d of %d trials finished (%f s)" % (
+            sum(result is not None for params, result in results),
+            len(results), time.time() - t0)
@@ -1,58 +1,193 @@
 """Library for QRI data to work with Keras"""
 
-import cPickle, gzip
+import cPickle, gzip, hashlib, json, os, sys, time, types
 import matplotlib.pyplot as plt
 import numpy as np
+import keras
 import theano
 import theano.tensor as T
 import warnings
+import figure_export
 
 
 # Ignore warnings
 warnings.simplefilter("ignore")
 
+# Compiled models are cached here by compile_model (None disables caching)
+COMPILE_CACHE = "compiled"
+
+# Absolute errors are clipped at this many standard deviations in mae_clip
+CLIP_VALUE = 6
+
 
 def load_data(filename):
-    """Load datasets from a file"""
+    """Load datasets from a file (or a memory-mapped dataset directory)"""
+    if os.path.isdir(filename):
+        return load_memmap_data(filename)
     with gzip.open(filename, "rb") as file:
         return cPickle.load(file)
-        
 
-def plot_test_predictions(model, test_set, display_figs=True, save_figs=False,
-                          output_folder="images", output_format="png"):
-    """Plots the predictions for the first batch of the test set"""
-    # Load test data and make prediction
-    x = test_set[0]
-    y = test_set[1]
-    predictions = model.predict(x, batch_size=1, verbose=0)
-    
-    # Plot each chunk with its prediction
-    for i, chunk in enumerate(zip(x, y, predictions)):        
-        # Create a figure and add a subplot with labels
-        fig = plt.figure()
-        graph = fig.add_subplot(111)
-        fig.suptitle("Chunk Data", fontsize=25)
-        plt.xlabel("Month", fontsize=15)
-        plt.ylabel("Production", fontsize=15)
 
-        # Make and display error label
-        loss = model.test_on_batch(chunk[0][np.newaxis], chunk[1][np.newaxis])
-        plt.title("Loss: %f" % loss, fontsize=10)
+def load_memmap_data(directory):
+    """Load datasets from a memory-mapped dataset directory (no copying)"""
+    with open(os.path.join(directory, "header.json")) as file:
+        header = json.load(file)
+    datasets = []
+    for name in ("train", "valid", "test"):
+        dataset = []
+        for part in ("x", "y"):
+            filename = os.path.join(directory, "%s_%s.bin" % (name, part))
+            shape = tuple(header["shapes"][name][part])
+            if shape[0] == 0:
+                # The empty file of a split without chunks can't be mapped
+                dataset.append(np.empty(shape, dtype=header["dtype"]))
+            else:
+                dataset.append(np.memmap(filename, dtype=header["dtype"],
+                                         mode="r", shape=shape))
+        datasets.append(tuple(dataset))
+    return datasets
+
+
+def load_cv_data(directory):
+    """Load the chunk store of a cross-validation directory (memory-mapped)
+       and its folds, a dictionary of (train, valid, test) row indices"""
+    with open(os.path.join(directory, "header.json")) as file:
+        header = json.load(file)
+    x, y = [np.memmap(os.path.join(directory, "%s.bin" % part),
+                      dtype=header["dtype"], mode="r",
+                      shape=tuple(header["shapes"][part]))
+            for part in ("x", "y")]
+    with np.load(os.path.join(directory, "folds.npz")) as file:
+        folds = dict((name, [file["%s_%s" % (name, split)]
+                             for split in ("train", "valid", "test")])
+                     for name in header["folds"])
+    return x, y, folds
+
+
+def fold_data(x, y, rows):
+    """Return the datasets of a fold (only its chunks are read into memory)"""
+    return [(x[split_rows], y[split_rows]) for split_rows in rows]
+
+
+def to_3d(datasets):
+    """Return datasets with 3D inputs (chunks, months, channels), adding a
+       channel axis (as a view) only to single-channel datasets"""
+    return [(x[:, :, np.newaxis] if x.ndim == 2 else x, y) for x, y in datasets]
+
+
+class WindowedSet(object):
+    """Dataset whose chunks are cut from the stored well series on demand"""
+
+    def __init__(self, series, starts, in_months, out_months, normalize=True):
+        self.series = series
+        self.starts = starts
+        self.in_months = in_months
+        self.out_months = out_months
+        self.normalize = normalize
+        self.offsets = np.arange(in_months + out_months)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        """Returns (x, y) arrays for the chunks at an index, slice or array of
+           indices, normalizing each chunk w/respect to its x"""
+        starts = np.atleast_1d(self.starts[index])
+        windows = self.series[starts[:, np.newaxis] + self.offsets]
+        x = windows[:, :self.in_months]
+        y = windows[:, self.in_months:]
+        if self.normalize:
+            mean = x.mean(axis=1, keepdims=True)
+            std = x.std(axis=1, keepdims=True)
+            std[std == 0] = 1
+            x = (x - mean)/std
+            y = (y - mean)/std
+
+        # Only oil (the first channel) is predicted
+        return x, y[..., 0] if y.ndim == 3 else y
+
+    def batches(self, batch_size, shuffle=False):
+        """Yields (x, y) batches covering the dataset once"""
+        indices = np.arange(len(self))
+        if shuffle:
+            np.random.shuffle(indices)
+        for i in xrange(0, len(indices), batch_size):
+            yield self[indices[i:i + batch_size]]
+
+
+def load_windowed_data(filename):
+    """Load windowed datasets (train, valid, test) from a file"""
+    with gzip.open(filename, "rb") as file:
+        return [WindowedSet(**split) for split in cPickle.load(file)]
+
+
+def evaluate_windowed(model, dataset, batch_size=1000):
+    """Returns the mean loss of the model over a windowed dataset"""
+    total = 0.0
+    for x, y in dataset.batches(batch_size):
+        total += model.test_on_batch(x, y)*len(x)
+    return total/len(dataset)
+
+
+def fit_windowed(model, train_set, valid_set, filepath, nb_epoch=1000,
+                 batch_size=20, patience=10, verbose=True):
+    """Train the model one batch at a time on windowed datasets with early
+       stopping, saving the best weights to filepath; returns the history"""
+    history = {"loss": [], "val_loss": []}
+    best_loss = np.inf
+    wait = 0
+    for epoch in xrange(nb_epoch):
+        # Train on shuffled batches and evaluate on the validation set
+        total = 0.0
+        for x, y in train_set.batches(batch_size, shuffle=True):
+            total += model.train_on_batch(x, y)*len(x)
+        history["loss"].append(total/len(train_set))
+        history["val_loss"].append(evaluate_windowed(model, valid_set))
+        if verbose:
+            print "Epoch %d - loss: %f - val_loss: %f" % (
+                epoch, history["loss"][-1], history["val_loss"][-1])
 
-        # Plot the predictions as a blue line with round markers
-        prediction = np.append(chunk[0].flatten(), chunk[2])
-        graph.plot(prediction, "b-o", label="Prediction")
+        # Save the best model and stop when it has not improved for a while
+        if history["val_loss"][-1] < best_loss:
+            best_loss = history["val_loss"][-1]
+            model.save_weights(filepath, overwrite=True)
+            wait = 0
+        else:
+            wait += 1
+            if wait >= patience:
+                break
+    return history
 
-        # Plot the future as a green line with round markers
-        future = np.append(chunk[0].flatten(), chunk[1])
-        graph.plot(future, "g-o", label="Future")
 
-        # Plot the past as a red line with round markers
-        past = chunk[0].flatten()
-        graph.plot(past, "r-o", label="Past")
+def evaluate_chunks(model, dataset, batch_size=1000):
+    """Returns the predictions and the loss (mae_clip) of every chunk of a
+       dataset, predicting in batches"""
+    predictions = model.predict(dataset[0], batch_size=batch_size, verbose=0)
+    return predictions, chunk_losses(dataset[1], predictions)
 
-        # Add legend
-        plt.legend(loc="upper left")
+
+def plot_test_predictions(model, test_set, display_figs=True, save_figs=False,
+                          output_folder="images", output_format="png",
+                          batch_size=1000):
+    """Plots the predictions for the first batch of the test set"""
+    predictions, losses = evaluate_chunks(model, test_set, batch_size)
+    plot_predictions(test_set, predictions, losses, display_figs, save_figs,
+                     output_folder, output_format)
+
+
+def plot_predictions(dataset, predictions, losses, display_figs=True,
+                     save_figs=False, output_folder="images",
+                     output_format="png"):
+    """Plots each chunk of a dataset with its prediction and loss"""
+    x = dataset[0]
+    y = dataset[1]
+
+    # Plot each chunk with its prediction
+    for i, chunk in enumerate(zip(x, y, predictions, losses)):
+        # Create a figure and draw the chunk with labels
+        fig = plt.figure()
+        fig.suptitle("Chunk Data", fontsize=25)
+        draw_chunk(fig.add_subplot(111), *chunk)
 
         # Save the graphs to a folder
         if save_figs:
@@ -67,6 +202,43 @@ def plot_test_predictions(model, test_set, display_figs=True, save_figs=False,
         plt.close(fig)
 
 
+def draw_chunk(graph, x, y, prediction, loss):
+    """Draws a chunk with its prediction and loss on a subplot"""
+    graph.set_xlabel("Month", fontsize=15)
+    graph.set_ylabel("Production", fontsize=15)
+
+    # Display error label
+    graph.set_title("Loss: %f" % loss, fontsize=10)
+
+    # Plot the predictions as a blue line with round markers
+    past = x.reshape(len(x), -1)[:, 0]
+    graph.plot(np.append(past, prediction), "b-o", label="Prediction")
+
+    # Plot the future as a green line with round markers
+    graph.plot(np.append(past, y), "g-o", label="Future")
+
+    # Plot the past (oil) as a red line with round markers
+    graph.plot(past, "r-o", label="Past")
+
+    # Add legend
+    graph.legend(loc="upper left")
+
+
+def export_predictions(dataset, predictions, losses, output_folder="images",
+                       output_format="png", grid=(1, 1), pdf_filename=None,
+                       workers=None):
+    """Saves plots of each chunk of a dataset with its prediction and loss
+       using a pool of processes (see figure_export.py); grid gives the
+       (rows, cols) of chunks per page (a contact sheet), and pdf_filename
+       writes all pages to a single PDF of raster images instead of one
+       file per page"""
+    items = (np.asarray(dataset[0]), np.asarray(dataset[1]), predictions,
+             losses)
+    return figure_export.export_pages(draw_chunk, items, "Chunk Data",
+                                      output_folder, output_format, grid,
+                                      pdf_filename, workers)
+
+
 def plot_train_valid_loss(history):
     """Plot the training and validation error as a function of epochs"""
     # Create a figure and add a subplot with labels
@@ -107,15 +279,105 @@ def plot_weights(layer, cmap="gray"):
 
 def mae_clip(y_true, y_pred):
     """Return the MAE with clipping to provide resistance to outliers"""
-    CLIP_VALUE = 6
     return T.clip(T.abs_(y_true - y_pred), 0, CLIP_VALUE).mean(axis=-1)
 
 
-def save_results(filename, time_elapsed, test_set_loss):
-    """Save performance of model to a file"""
+def chunk_losses(y_true, y_pred):
+    """Return the loss of each chunk computed like mae_clip, in NumPy"""
+    return np.clip(np.abs(y_true - y_pred), 0, CLIP_VALUE).mean(axis=-1)
+
+
+def object_signature(obj):
+    """Return the class and configuration (get_config) of a layer or
+       optimizer, or None if it has no configuration that can be saved as
+       JSON"""
+    try:
+        config = obj.get_config()
+        json.dumps(config, sort_keys=True)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return [type(obj).__name__, config]
+
+
+def code_digest(code):
+    """Return a digest of the bytecode and constants of a code object (and
+       of the code objects nested in it)"""
+    consts = [code_digest(const) if isinstance(const, types.CodeType)
+              else repr(const) for const in code.co_consts]
+    return hashlib.sha1(code.co_code + repr(consts) +
+                        repr(code.co_names)).hexdigest()
+
+
+def compile_key(model, loss, optimizer):
+    """Return the cache key of a model compiled with a loss and optimizer,
+       or None if a layer, the loss or the optimizer has settings that the
+       key can't capture"""
+    signatures = [object_signature(obj) for obj in model.layers + [optimizer]]
+    if None in signatures:
+        return None
+    # The loss is known by name and by a digest of its code (mae_clip also
+    # by its clipping value), so editing a loss compiles it again; a lambda
+    # or closure could hide settings, so it isn't cached
+    if callable(loss):
+        if (loss.__name__ == "<lambda>" or not hasattr(loss, "func_code") or
+                loss.func_closure):
+            return None
+        name = "%s.%s" % (loss.__module__, loss.__name__)
+        loss = [name, code_digest(loss.func_code)]
+        if name == mae_clip.__module__ + ".mae_clip":
+            loss.append(CLIP_VALUE)
+    signature = [signatures, loss, theano.__version__,
+                 getattr(keras, "__version__", ""), theano.config.floatX,
+                 theano.config.device]
+    return hashlib.sha1(json.dumps(signature, sort_keys=True)).hexdigest()
+
+
+def compile_model(model, loss, optimizer, cache_directory=COMPILE_CACHE):
+    """Compile a model, reusing the compiled functions cached by an earlier
+       run with the same layers, loss and optimizer (models whose settings
+       the cache key can't capture are always compiled); return the
+       compiled model (with the weights of the given model) and the seconds
+       spent compiling or loading it"""
+    t0 = time.time()
+    key = None if cache_directory is None else compile_key(model, loss,
+                                                           optimizer)
+    if key is None:
+        model.compile(loss=loss, optimizer=optimizer)
+        return model, time.time() - t0
+
+    # Load the cached model without optimizing its graph again
+    filename = os.path.join(cache_directory, "%s.pkl" % key)
+    if os.path.exists(filename):
+        reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        try:
+            with open(filename, "rb") as file:
+                cached = cPickle.load(file)
+        finally:
+            theano.config.reoptimize_unpickled_function = reoptimize
+        cached.set_weights(model.get_weights())
+        return cached, time.time() - t0
+
+    # Compile and cache the model before it is trained
+    model.compile(loss=loss, optimizer=optimizer)
+    compile_time = time.time() - t0
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+    tempname = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tempname, "wb") as file:
+        cPickle.dump(model, file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tempname, filename)
+    return model, compile_time
+
+
+def save_results(filename, time_elapsed, test_set_loss, compile_time=None):
+    """Save performance of model (and time spent compiling it) to a file"""
     with open(filename, "w") as file:
         file.write("Time elapsed: %f s\n" % time_elapsed)
         file.write("Testing set loss: %f" % test_set_loss)
+        if compile_time is not None:
+            file.write("\nCompile time: %f s" % compile_time)
 
 
 def save_history(filename, history):
@@ -0,0 +1,283 @@
+"""Train the models described by JSON (or YAML) specs on the QRI data
+
+Usage: python runner.py specs/lstm.json [specs/gru.json ...]
+
+Each spec file holds one spec or a list of specs. A spec names the model,
+the shape of its inputs and its layers; anything left out is taken from
+DEFAULT_SPEC. The datasets are loaded once and every model is trained on
+them, one after another or in WORKERS processes."""
+
+import json
+import multiprocessing
+import numpy as np
+import os
+import sys
+import time
+import qri
+import trialdb
+from keras import optimizers
+from keras.callbacks import Callback, EarlyStopping, ModelCheckpoint
+from keras.layers import convolutional, core, recurrent
+from keras.models import Sequential
+
+# YAML specs are only supported if PyYAML is installed
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Dataset the models are trained on
+DATA_FILENAME = "../datasets/qri.pkl.gz"
+
+# Number of models trained at the same time (one process each)
+WORKERS = 1
+
+# Plot the losses and test predictions of each model after training
+PLOT_RESULTS = False
+
+# Database every trained model is recorded in (None disables it)
+RESULTS_DATABASE = "results/trials.db"
+
+# Save the latest weights and the training state every CHECKPOINT_EPOCHS
+# epochs, so that a model whose training was interrupted can resume (needs
+# the results database)
+CHECKPOINT_EPOCHS = 10
+
+# Settings used when a spec leaves them out (same as the model scripts)
+DEFAULT_SPEC = {
+    "seed": 42,
+    "data": "2d",
+    "loss": "mae_clip",
+    "optimizer": {"name": "SGD", "lr": 0.001, "momentum": 0.99,
+                  "decay": 1e-6, "nesterov": True},
+    "patience": 10,
+    "nb_epoch": 1000,
+    "batch_size": 20,
+    "verbose": 2,
+}
+
+# Layer classes that specs can use, by name
+LAYER_MODULES = (core, convolutional, recurrent)
+
+# Datasets shared by the models trained in this process
+datasets = None
+
+
+def load_specs(filename):
+    """Return the list of specs in a JSON or YAML file, with defaults filled
+       in"""
+    with open(filename) as file:
+        if filename.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ImportError("PyYAML is needed to read %s" % filename)
+            specs = yaml.safe_load(file)
+        else:
+            specs = json.load(file)
+    if isinstance(specs, dict):
+        specs = [specs]
+    return [dict(DEFAULT_SPEC, **spec) for spec in specs]
+
+
+def get_datasets(spec):
+    """Return the shared datasets as 2D or 3D datasets for a spec"""
+    if spec["data"] == "3d":
+        return qri.to_3d(datasets)
+    return datasets
+
+
+def build_model(spec, train_set):
+    """Return the compiled model of a spec and the time spent compiling it;
+       the layer arguments "channels" and "inputs" stand for the number of
+       input channels and inputs, and "previous" for the output size of the
+       last layer that has one (Dense and recurrent layers)"""
+    sizes = {"channels": train_set[0].shape[-1],
+             "inputs": train_set[0][0].size,
+             "previous": train_set[0][0].size}
+    model = Sequential()
+    for layer in spec["layers"]:
+        layer = dict(layer)
+        name = layer.pop("layer")
+        args = [sizes.get(arg, arg) if isinstance(arg, basestring) else arg
+                for arg in layer.pop("args", [])]
+        for module in LAYER_MODULES:
+            if hasattr(module, name):
+                model.add(getattr(module, name)(*args, **layer))
+                sizes["previous"] = getattr(model.layers[-1], "output_dim",
+                                            sizes["previous"])
+                break
+        else:
+            raise ValueError("Unknown layer %s in spec %s"
+                             % (name, spec["name"]))
+
+    # Compile with the optimizer and loss of the spec (or load the model
+    # from the compile cache)
+    optimizer = dict(spec["optimizer"])
+    optimizer = getattr(optimizers, optimizer.pop("name"))(**optimizer)
+    loss = qri.mae_clip if spec["loss"] == "mae_clip" else spec["loss"]
+    return qri.compile_model(model, loss, optimizer)
+
+
+class TrialCheckpoint(Callback):
+    """Collects the history of a trial and, every period epochs, saves the
+       latest weights of its model and records its state (epochs, history,
+       best validation loss and time) in the results database"""
+
+    def __init__(self, filepath, trial, period=CHECKPOINT_EPOCHS):
+        super(TrialCheckpoint, self).__init__()
+        self.filepath = filepath
+        self.trial = trial
+        self.period = period
+
+    def on_train_begin(self, logs={}):
+        self.t0 = time.time() - self.trial["time_elapsed"]
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.seen = 0
+        self.totals = {}
+
+    def on_batch_end(self, batch, logs={}):
+        # Add up the batch losses like History does, as the epoch logs of
+        # older Keras versions only hold the validation metrics
+        batch_size = logs.get("size", 0)
+        self.seen += batch_size
+        for key, value in logs.items():
+            if key not in ("batch", "size"):
+                self.totals[key] = self.totals.get(key, 0.) + value*batch_size
+
+    def on_epoch_end(self, epoch, logs={}):
+        trial = self.trial
+        values = dict((key, total/self.seen)
+                      for key, total in self.totals.items() if self.seen)
+        values.update(logs)
+        for key, value in values.items():
+            trial["history"].setdefault(key, []).append(float(value))
+        trial["epochs"] += 1
+        trial["time_elapsed"] = time.time() - self.t0
+        if RESULTS_DATABASE is None or trial["epochs"] % self.period:
+            return
+
+        # Replace the checkpoint in one step so that it is never partial
+        self.model.save_weights(self.filepath + ".tmp", overwrite=True)
+        os.rename(self.filepath + ".tmp", self.filepath)
+        trial["valid_loss"] = min(trial["history"]["val_loss"])
+        trialdb.save_trial(RESULTS_DATABASE, trial)
+
+
+def start_trial(spec, compile_time):
+    """Return the training state of the trial of a spec, continuing from
+       its last checkpoint if an earlier run was interrupted (the trial is
+       recorded as running)"""
+    trial = {"sweep": spec.get("sweep"), "name": spec["name"],
+             "status": "running", "params": spec.get("params"),
+             "spec": spec, "epochs": 0, "valid_loss": None,
+             "time_elapsed": 0., "compile_time": compile_time,
+             "history": {}}
+    if RESULTS_DATABASE is None:
+        return trial
+    saved = trialdb.get_trial(RESULTS_DATABASE, spec["name"],
+                              spec.get("sweep"))
+    if (saved is not None and saved["status"] in ("running", "failed") and
+            saved["epochs"] and
+            os.path.exists("models/%s.last.mdl" % spec["name"])):
+        for key in ("epochs", "valid_loss", "time_elapsed", "history"):
+            trial[key] = saved[key]
+    trialdb.save_trial(RESULTS_DATABASE, trial)
+    return trial
+
+
+def train_model(spec):
+    """Train the model of a spec like the model scripts do, saving its
+       results and history; a model whose training was interrupted
+       continues from its last checkpoint. Return (name, time elapsed, test
+       set loss)"""
+    name = spec["name"]
+    np.random.seed(spec["seed"])
+    train_set, valid_set, test_set = get_datasets(spec)
+    model, compile_time = build_model(spec, train_set)
+    trial = start_trial(spec, compile_time)
+
+    # Use early stopping, saving and checkpointing as callbacks
+    early_stop = EarlyStopping(monitor="val_loss", patience=spec["patience"])
+    save_best = ModelCheckpoint("models/%s.mdl" % name, save_best_only=True)
+    checkpoint = TrialCheckpoint("models/%s.last.mdl" % name, trial)
+
+    # Continue from the checkpoint with the early stopping state it had
+    if trial["epochs"]:
+        print "%s - Resuming after %d epochs" % (name, trial["epochs"])
+        model.load_weights(checkpoint.filepath)
+        valid_loss = trial["history"]["val_loss"]
+        early_stop.best = save_best.best = min(valid_loss)
+        early_stop.wait = len(valid_loss) - 1 - valid_loss.index(
+            min(valid_loss))
+
+    # Train model
+    callbacks = [early_stop, save_best, checkpoint]
+    if spec["nb_epoch"] > trial["epochs"]:
+        model.fit(train_set[0], train_set[1], validation_data=valid_set,
+                  verbose=spec["verbose"], callbacks=callbacks,
+                  nb_epoch=spec["nb_epoch"] - trial["epochs"],
+                  batch_size=spec["batch_size"])
+    time_elapsed = trial["time_elapsed"]
+    history = trial["history"]
+
+    # Load best model and evaluate it on the testing dataset
+    model.load_weights("models/%s.mdl" % name)
+    test_set_loss = model.test_on_batch(test_set[0], test_set[1])
+    print "\n%s - Compile time: %f s" % (name, compile_time)
+    print "%s - Time elapsed: %f s" % (name, time_elapsed)
+    print "%s - Testing set loss: %f" % (name, test_set_loss)
+
+    # Save results
+    qri.save_results("results/%s.out" % name, time_elapsed, test_set_loss,
+                     compile_time)
+    qri.save_history("models/%s.hist" % name, history)
+
+    # Record the model's configuration, history and results (specs made by
+    # sweep.py also name their sweep and parameters) and drop its checkpoint
+    if RESULTS_DATABASE is not None:
+        trial.update(status="done", valid_loss=min(history["val_loss"]),
+                     test_set_loss=float(test_set_loss))
+        trialdb.save_trial(RESULTS_DATABASE, trial)
+        if os.path.exists(checkpoint.filepath):
+            os.remove(checkpoint.filepath)
+
+    # Plot training and validation loss and predictions
+    if PLOT_RESULTS:
+        qri.plot_train_valid_loss(history)
+        qri.plot_test_predictions(model, train_set)
+    return name, time_elapsed, float(test_set_loss)
+
+
+def init_worker(filename):
+    """Load the datasets in a worker unless they were inherited from the
+       parent process"""
+    global datasets
+    if datasets is None:
+        datasets = qri.load_data(filename)
+
+
+def run_specs(specs, workers=WORKERS, filename=DATA_FILENAME):
+    """Train the models of all specs on datasets loaded once; return the
+       (name, time elapsed, test set loss) of each"""
+    # Workers started by fork share the parent's datasets
+    init_worker(filename)
+    if workers <= 1 or len(specs) <= 1:
+        return map(train_model, specs)
+    pool = multiprocessing.Pool(min(workers, len(specs)), init_worker,
+                                (filename,))
+    try:
+        return pool.map(train_model, specs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    specs = [spec for filename in sys.argv[1:]
+             for spec in load_specs(filename)]
+    results = run_specs(specs)
+
+    # Print a comparison of the models
+    print "\n%-24s %14s %14s" % ("Model", "Time (s)", "Test loss")
+    for name, time_elapsed, test_set_loss in results:
+        print "%-24s %14f %14f" % (name, time_elapsed, test_set_loss)
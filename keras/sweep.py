@@ -0,0 +1,194 @@
+"""Run a hyperparameter sweep of the Keras models on one machine
+
+Usage: python sweep.py sweeps/fcn-hl.json
+
+A sweep file holds a spec template for runner.py, a pattern for the model
+names and a grid of parameter values. Every combination of grid values is
+one trial, whose spec is the template with each "$parameter" string
+replaced by the parameter's value; a layer group {"repeat": n, "layers":
+[...]} in the template stands for its layers repeated n times. The trials
+run in a pool of WORKERS processes that load the dataset once each, and the
+result of every trial is appended to the sweep's results file as soon as
+it finishes. The state of every trial (pending, running, done or failed)
+is kept in the results database, so running an interrupted sweep again
+skips the trials that are done and continues the others from their last
+checkpoint."""
+
+import os
+
+# Number of threads BLAS may use in each worker (set before NumPy loads
+# BLAS, so that WORKERS trials don't compete for the same cores)
+BLAS_THREADS = 1
+for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                 "MKL_NUM_THREADS"):
+    os.environ[variable] = str(BLAS_THREADS)
+
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+import traceback
+import runner
+import trialdb
+
+# Number of trials trained at the same time (one process each)
+WORKERS = multiprocessing.cpu_count()
+
+# Directory of the sweep results files (<sweep>.sweep)
+RESULTS_DIRECTORY = "results"
+
+
+def load_sweep(filename):
+    """Return the sweep in a JSON file; its name defaults to the file name"""
+    with open(filename) as file:
+        sweep = json.load(file)
+    sweep.setdefault("sweep", os.path.splitext(os.path.basename(filename))[0])
+    return sweep
+
+
+def grid_values(values):
+    """Return the values of a grid parameter, given as a list or as
+       {"range": [start, stop, step]}"""
+    if isinstance(values, dict):
+        return range(*values["range"])
+    return values
+
+
+def fill_template(template, params):
+    """Return a copy of a spec template with "$parameter" strings replaced
+       by parameter values and repeated layer groups expanded"""
+    if isinstance(template, basestring) and template.startswith("$"):
+        return params[template[1:]]
+    if isinstance(template, dict):
+        return dict((key, fill_template(value, params))
+                    for key, value in template.items())
+    if isinstance(template, list):
+        filled = []
+        for item in [fill_template(item, params) for item in template]:
+            if isinstance(item, dict) and "repeat" in item:
+                filled.extend(item["layers"]*item["repeat"])
+            else:
+                filled.append(item)
+        return filled
+    return template
+
+
+def make_trials(sweep):
+    """Return the (parameters, spec) of every trial of a sweep"""
+    names = sorted(sweep["grid"])
+    grid = [grid_values(sweep["grid"][name]) for name in names]
+    trials = []
+    for values in itertools.product(*grid):
+        params = dict(zip(names, values))
+        spec = dict(runner.DEFAULT_SPEC,
+                    **fill_template(sweep["spec"], params))
+        spec["name"] = sweep["name"] % params
+        spec["sweep"] = sweep["sweep"]
+        spec["params"] = params
+        trials.append((params, spec))
+    return trials
+
+
+def run_trial(trial):
+    """Train the model of a trial; return its parameters and its (name,
+       time elapsed, test set loss), or None if training failed"""
+    params, spec = trial
+    try:
+        return params, runner.train_model(spec)
+    except Exception:
+        print "%s - Failed:\n%s" % (spec["name"], traceback.format_exc())
+        if runner.RESULTS_DATABASE is not None:
+            trialdb.set_status(runner.RESULTS_DATABASE, spec["name"],
+                               "failed", spec["sweep"])
+        return params, None
+
+
+def pending_trials(sweep, trials):
+    """Record the trials of a sweep as pending in the results database
+       (unless they are there already) and return those that are not done;
+       without a database every trial is returned"""
+    if runner.RESULTS_DATABASE is None:
+        return trials
+    trialdb.add_trials(runner.RESULTS_DATABASE, [
+        {"sweep": spec["sweep"], "name": spec["name"], "status": "pending",
+         "params": params, "spec": spec} for params, spec in trials])
+    done = set(trial["name"] for trial in trialdb.query(
+        runner.RESULTS_DATABASE, sweep["sweep"], status="done"))
+    return [(params, spec) for params, spec in trials
+            if spec["name"] not in done]
+
+
+def run_sweep(sweep, workers=WORKERS, filename=runner.DATA_FILENAME,
+              trials=None, results_name=None):
+    """Run every trial of a sweep (or the given trials of it) that is not
+       done yet (interrupted trials continue from their last checkpoint),
+       appending each result to the sweep's results file (or to
+       results_name.sweep) as it finishes; return the results"""
+    if trials is None:
+        trials = make_trials(sweep)
+    count = len(trials)
+    trials = pending_trials(sweep, trials)
+    if len(trials) < count:
+        print "Resuming %s: %d of %d trials are done" % (
+            sweep["sweep"], count - len(trials), count)
+    names = sorted(sweep["grid"])
+    if not os.path.isdir(RESULTS_DIRECTORY):
+        os.makedirs(RESULTS_DIRECTORY)
+    results_filename = os.path.join(RESULTS_DIRECTORY, "%s.sweep" % (
+        results_name or sweep["sweep"]))
+
+    # Workers started by fork share the parent's datasets
+    runner.init_worker(filename)
+    pool = None
+    if workers <= 1 or len(trials) <= 1:
+        finished = itertools.imap(run_trial, trials)
+    else:
+        pool = multiprocessing.Pool(min(workers, len(trials)),
+                                    runner.init_worker, (filename,))
+        finished = pool.imap_unordered(run_trial, trials, chunksize=1)
+
+    # Write a tab-separated line per trial in the order they finish (after
+    # the lines of earlier runs of the sweep)
+    results = []
+    t0 = time.time()
+    try:
+        header = not os.path.exists(results_filename)
+        with open(results_filename, "a") as file:
+            if header:
+                file.write("\t".join(["name"] + names +
+                                     ["time_elapsed", "test_set_loss"]) +
+                           "\n")
+            for params, result in finished:
+                results.append((params, result))
+                print "Finished %d/%d trials (%f s)" % (len(results),
+                                                       len(trials),
+                                                       time.time() - t0)
+                if result is None:
+                    continue
+                name, time_elapsed, test_set_loss = result
+                values = [str(params[param]) for param in names]
+                file.write("\t".join([name] + values +
+                                     ["%f" % time_elapsed,
+                                      "%f" % test_set_loss]) + "\n")
+                file.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return results
+
+
+if __name__ == '__main__':
+    for filename in sys.argv[1:]:
+        sweep = load_sweep(filename)
+        results = run_sweep(sweep)
+
+        # Print the best trials of the sweep
+        done = sorted((result for params, result in results
+                       if result is not None), key=lambda result: result[2])
+        print "\n%s: %d of %d trials finished" % (sweep["sweep"], len(done),
+                                                  len(results))
+        print "%-32s %14s %14s" % ("Model", "Time (s)", "Test loss")
+        for name, time_elapsed, test_set_loss in done[:10]:
+            print "%-32s %14f %14f" % (name, time_elapsed, test_set_loss)
@@ -0,0 +1,248 @@
+"""SQLite store of training trials: configuration, history and results
+
+Every trial is one row of the trials table, identified by its sweep and
+model name and holding its parameters and spec (as JSON), its status
+(pending, running, trained after a Hyperband rung, done or failed), the
+number of epochs trained, its best validation loss, the time spent
+training and compiling and its testing set loss. The training history is
+kept one value per row (trial, metric, epoch). Each call opens its own
+connection, so worker processes can write to the same database at the same
+time: writes are short transactions that wait up to TIMEOUT seconds for the
+database to be free."""
+
+import json
+import os
+import re
+import sqlite3
+import time
+
+# Seconds a writer waits for another writer to finish
+TIMEOUT = 60
+
+# Journal mode of new connections; write-ahead logging lets readers and a
+# writer work at the same time ("delete" is safer on network file systems)
+JOURNAL_MODE = "wal"
+
+SCHEMA = """
+create table if not exists trials (
+    id integer primary key,
+    sweep text not null default '',
+    name text not null,
+    status text,
+    params text,
+    spec text,
+    epochs integer,
+    valid_loss real,
+    time_elapsed real,
+    compile_time real,
+    test_set_loss real,
+    updated real,
+    unique (sweep, name)
+);
+create table if not exists history (
+    trial integer not null references trials (id),
+    metric text not null,
+    epoch integer not null,
+    value real,
+    primary key (trial, metric, epoch)
+);
+"""
+
+# Columns of the trials table that are stored as JSON
+JSON_FIELDS = ("params", "spec")
+
+# Columns of the trials table set by save_trial
+FIELDS = ("status", "params", "spec", "epochs", "valid_loss", "time_elapsed",
+          "compile_time", "test_set_loss")
+
+
+def connect(filename):
+    """Return a connection to a trials database, creating it if needed"""
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    connection = sqlite3.connect(filename, timeout=TIMEOUT,
+                                 isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("pragma journal_mode = %s" % JOURNAL_MODE)
+
+    # Create the tables under the write lock, as several processes may
+    # open a new database at the same time
+    with connection:
+        connection.execute("begin immediate")
+        for statement in SCHEMA.split(";"):
+            connection.execute(statement)
+    return connection
+
+
+def save_trial(filename, trial):
+    """Insert or update a trial given as a dictionary with its "name" and
+       any of "sweep", "history" and the FIELDS (fields left out are
+       cleared); return its id"""
+    values = [json.dumps(trial[field], sort_keys=True)
+              if field in JSON_FIELDS and field in trial
+              else trial.get(field) for field in FIELDS]
+    sweep = trial.get("sweep") or ""
+    connection = connect(filename)
+    try:
+        # Take the write lock at once so that the lookup and the write
+        # can't interleave with another writer
+        with connection:
+            connection.execute("begin immediate")
+            row = connection.execute(
+                "select id from trials where sweep = ? and name = ?",
+                (sweep, trial["name"])).fetchone()
+            if row is None:
+                trial_id = connection.execute(
+                    "insert into trials (sweep, name, %s, updated) "
+                    "values (?, ?, %s, ?)" % (", ".join(FIELDS),
+                                              ", ".join("?"*len(FIELDS))),
+                    [sweep, trial["name"]] + values + [time.time()]
+                ).lastrowid
+            else:
+                trial_id = row["id"]
+                connection.execute(
+                    "update trials set %s, updated = ? where id = ?"
+                    % ", ".join("%s = ?" % field for field in FIELDS),
+                    values + [time.time(), trial_id])
+
+            # Replace the stored history with the trial's
+            if trial.get("history") is not None:
+                connection.execute("delete from history where trial = ?",
+                                   (trial_id,))
+                connection.executemany(
+                    "insert into history values (?, ?, ?, ?)",
+                    [(trial_id, metric, epoch, float(value))
+                     for metric, values in trial["history"].items()
+                     for epoch, value in enumerate(values)])
+        return trial_id
+    finally:
+        connection.close()
+
+
+def add_trials(filename, trials):
+    """Add trials (dictionaries with their "name" and any of "sweep" and the
+       FIELDS) that are not in the database yet, leaving existing trials
+       unchanged"""
+    rows = [[trial.get("sweep") or "", trial["name"]] +
+            [json.dumps(trial[field], sort_keys=True)
+             if field in JSON_FIELDS and field in trial
+             else trial.get(field) for field in FIELDS] + [time.time()]
+            for trial in trials]
+    connection = connect(filename)
+    try:
+        with connection:
+            connection.execute("begin immediate")
+            connection.executemany(
+                "insert or ignore into trials (sweep, name, %s, updated) "
+                "values (?, ?, %s, ?)" % (", ".join(FIELDS),
+                                          ", ".join("?"*len(FIELDS))), rows)
+    finally:
+        connection.close()
+
+
+def set_status(filename, name, status, sweep=None):
+    """Change the status of a trial, leaving the rest of it unchanged"""
+    connection = connect(filename)
+    try:
+        with connection:
+            connection.execute(
+                "update trials set status = ?, updated = ? "
+                "where sweep = ? and name = ?",
+                (status, time.time(), sweep or "", name))
+    finally:
+        connection.close()
+
+
+def get_trial(filename, name, sweep=None):
+    """Return a trial (as a dictionary, with its history) or None if it is
+       not in the database"""
+    for trial in query(filename, sweep or "", name=name):
+        trial["history"] = get_history(filename, name, sweep)
+        return trial
+    return None
+
+
+def query(filename, sweep=None, status=None, name=None, **params):
+    """Return the trials (as dictionaries) of a sweep, or of every sweep if
+       sweep is None, optionally only those with a status or name and with
+       the given parameter values"""
+    conditions = []
+    args = []
+    if name is not None:
+        conditions.append("name = ?")
+        args.append(name)
+    if sweep is not None:
+        conditions.append("sweep = ?")
+        args.append(sweep)
+    if status is not None:
+        conditions.append("status = ?")
+        args.append(status)
+    sql = "select * from trials"
+    if conditions:
+        sql += " where " + " and ".join(conditions)
+    connection = connect(filename)
+    try:
+        rows = connection.execute(sql + " order by id", args).fetchall()
+    finally:
+        connection.close()
+
+    # Decode the JSON columns and filter on the parameters
+    trials = []
+    for row in rows:
+        trial = dict(zip(row.keys(), row))
+        for field in JSON_FIELDS:
+            if trial[field] is not None:
+                trial[field] = json.loads(trial[field])
+        if all((trial["params"] or {}).get(param) == value
+               for param, value in params.items()):
+            trials.append(trial)
+    return trials
+
+
+def get_history(filename, name, sweep=None):
+    """Return the history of a trial as a dictionary mapping each metric to
+       its values per epoch"""
+    connection = connect(filename)
+    try:
+        rows = connection.execute(
+            "select metric, value from history join trials "
+            "on history.trial = trials.id "
+            "where trials.sweep = ? and trials.name = ? "
+            "order by metric, epoch", (sweep or "", name)).fetchall()
+    finally:
+        connection.close()
+    history = {}
+    for metric, value in rows:
+        history.setdefault(metric, []).append(value)
+    return history
+
+
+def import_results(filename, sweep, directory, pattern):
+    """Add the results files (.out) in a directory whose names match a
+       regular expression to a sweep; the named groups of the expression
+       give the trial's (integer) parameters. Both the bare format (time
+       elapsed, testing set loss) and the labelled format of save_results
+       are read. Return the number of trials added"""
+    count = 0
+    for name in sorted(os.listdir(directory)):
+        match = re.match(pattern, name)
+        if match is None:
+            continue
+        with open(os.path.join(directory, name)) as file:
+            numbers = [float(re.search(r"[-+]?[\d.]+(?:[eE][-+]?\d+)?",
+                                       line).group())
+                       for line in file if line.strip()]
+        params = dict((param, int(value)) for param, value
+                      in match.groupdict().items())
+        save_trial(filename, {
+            "sweep": sweep, "name": os.path.splitext(name)[0],
+            "status": "done", "params": params,
+            "time_elapsed": numbers[0], "test_set_loss": numbers[1],
+            "compile_time": numbers[2] if len(numbers) > 2 else None})
+        count += 1
+    return count
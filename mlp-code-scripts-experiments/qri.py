@@ -1,42 +1,84 @@
 """Library for QRI data to work with Keras"""
 
-import cPickle, gzip
+import cPickle, gzip, hashlib, json, os, sys, time, types
 import matplotlib.pyplot as plt
 import numpy as np
+import keras
 import theano
 import theano.tensor as T
 import warnings
+from numpy.lib.stride_tricks import as_strided
 
 
 # Ignore warnings
 warnings.simplefilter("ignore")
 
+# Compiled models are cached here by compile_model (None disables caching)
+COMPILE_CACHE = "compiled"
+
+# Absolute errors are clipped at this many standard deviations in mae_clip
+CLIP_VALUE = 6
+
 
 def load_data(filename):
-    """Load datasets from a file"""
+    """Load datasets from a file (or a memory-mapped dataset directory)"""
+    if os.path.isdir(filename):
+        return load_memmap_data(filename)
     with gzip.open(filename, "rb") as file:
         return cPickle.load(file)
 
-def load_data_recurrent(filename, timesteps=1):
-    """ Load datasets into 3D arrays from a file """
-    def make3d(data):
-        seq = []
-        for i in xrange(0, len(data), timesteps):
-            seq.append([data[i]])
-        return seq
 
-    train_set, valid_set, test_set = load_data(filename)
+def load_memmap_data(directory):
+    """Load datasets from a memory-mapped dataset directory (no copying)"""
+    with open(os.path.join(directory, "header.json")) as file:
+        header = json.load(file)
+    datasets = []
+    for name in ("train", "valid", "test"):
+        dataset = []
+        for part in ("x", "y"):
+            filename = os.path.join(directory, "%s_%s.bin" % (name, part))
+            shape = tuple(header["shapes"][name][part])
+            if shape[0] == 0:
+                # The empty file of a split without chunks can't be mapped
+                dataset.append(np.empty(shape, dtype=header["dtype"]))
+            else:
+                dataset.append(np.memmap(filename, dtype=header["dtype"],
+                                         mode="r", shape=shape))
+        datasets.append(tuple(dataset))
+    return datasets
+
+
+def make_sequences(x, timesteps=1, window=None):
+    """Return chunk inputs as (chunks, timesteps, features) sequences without
+       copying: each step holds window consecutive months (of every channel)
+       and the steps are spread evenly over the input months, the last step
+       ending with the last input month (by default they split the months
+       into timesteps equal parts; months that don't fit are left out at the
+       start of the input, never at the end)"""
+    x = np.ascontiguousarray(x)
+    x = x.reshape(x.shape[0], x.shape[1], -1)
+    months = x.shape[1]
+    if window is None:
+        window = months//timesteps
+    step = (months - window)//(timesteps - 1) if timesteps > 1 else window
+    if window < 1 or step < 1 or step*(timesteps - 1) + window > months:
+        raise ValueError("Cannot make %d steps of %d months from %d months"
+                         % (timesteps, window, months))
 
-    train_x = make3d(train_set[0])
-    valid_x = make3d(valid_set[0])
-    test_x = make3d(test_set[0])
+    # Step i of a chunk starts months - window - step*(timesteps - 1 - i)
+    # months into its row, so that the most recent months are always used
+    x = x[:, months - window - step*(timesteps - 1):]
+    shape = (x.shape[0], timesteps, window*x.shape[2])
+    strides = (x.strides[0], step*x.strides[1], x.strides[2])
+    return as_strided(x, shape=shape, strides=strides, writeable=False)
 
-     # Make datasets
-    train_set = (np.array(train_x), train_set[1])
-    valid_set = (np.array(valid_x), valid_set[1])
-    test_set = (np.array(test_x), test_set[1])
 
-    return train_set, valid_set, test_set
+def load_data_recurrent(filename, timesteps=1, window=None):
+    """Load datasets with 3D inputs (chunks, timesteps, features) from a
+       file; inputs are strided views and outputs are returned as loaded"""
+    return [(make_sequences(x, timesteps, window), y)
+            for x, y in load_data(filename)]
+
 
 def plot_test_predictions(model, test_set, display_figs=True, save_figs=False,
                           output_folder="images", output_format="png"):
@@ -127,15 +169,100 @@ def plot_weights(layer, cmap="gray"):
 
 def mae_clip(y_true, y_pred):
     """Return the MAE with clipping to provide resistance to outliers"""
-    CLIP_VALUE = 6
     return T.clip(T.abs_(y_true - y_pred), 0, CLIP_VALUE).mean(axis=-1)
 
 
-def save_results(filename, time_elapsed, test_set_loss):
-    """Save performance of model to a file"""
+def object_signature(obj):
+    """Return the class and configuration (get_config) of a layer or
+       optimizer, or None if it has no configuration that can be saved as
+       JSON"""
+    try:
+        config = obj.get_config()
+        json.dumps(config, sort_keys=True)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return [type(obj).__name__, config]
+
+
+def code_digest(code):
+    """Return a digest of the bytecode and constants of a code object (and
+       of the code objects nested in it)"""
+    consts = [code_digest(const) if isinstance(const, types.CodeType)
+              else repr(const) for const in code.co_consts]
+    return hashlib.sha1(code.co_code + repr(consts) +
+                        repr(code.co_names)).hexdigest()
+
+
+def compile_key(model, loss, optimizer):
+    """Return the cache key of a model compiled with a loss and optimizer,
+       or None if a layer, the loss or the optimizer has settings that the
+       key can't capture"""
+    signatures = [object_signature(obj) for obj in model.layers + [optimizer]]
+    if None in signatures:
+        return None
+    # The loss is known by name and by a digest of its code (mae_clip also
+    # by its clipping value), so editing a loss compiles it again; a lambda
+    # or closure could hide settings, so it isn't cached
+    if callable(loss):
+        if (loss.__name__ == "<lambda>" or not hasattr(loss, "func_code") or
+                loss.func_closure):
+            return None
+        name = "%s.%s" % (loss.__module__, loss.__name__)
+        loss = [name, code_digest(loss.func_code)]
+        if name == mae_clip.__module__ + ".mae_clip":
+            loss.append(CLIP_VALUE)
+    signature = [signatures, loss, theano.__version__,
+                 getattr(keras, "__version__", ""), theano.config.floatX,
+                 theano.config.device]
+    return hashlib.sha1(json.dumps(signature, sort_keys=True)).hexdigest()
+
+
+def compile_model(model, loss, optimizer, cache_directory=COMPILE_CACHE):
+    """Compile a model, reusing the compiled functions cached by an earlier
+       run with the same layers, loss and optimizer (models whose settings
+       the cache key can't capture are always compiled); return the
+       compiled model (with the weights of the given model) and the seconds
+       spent compiling or loading it"""
+    t0 = time.time()
+    key = None if cache_directory is None else compile_key(model, loss,
+                                                           optimizer)
+    if key is None:
+        model.compile(loss=loss, optimizer=optimizer)
+        return model, time.time() - t0
+
+    # Load the cached model without optimizing its graph again
+    filename = os.path.join(cache_directory, "%s.pkl" % key)
+    if os.path.exists(filename):
+        reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        try:
+            with open(filename, "rb") as file:
+                cached = cPickle.load(file)
+        finally:
+            theano.config.reoptimize_unpickled_function = reoptimize
+        cached.set_weights(model.get_weights())
+        return cached, time.time() - t0
+
+    # Compile and cache the model before it is trained
+    model.compile(loss=loss, optimizer=optimizer)
+    compile_time = time.time() - t0
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+    tempname = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tempname, "wb") as file:
+        cPickle.dump(model, file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tempname, filename)
+    return model, compile_time
+
+
+def save_results(filename, time_elapsed, test_set_loss, compile_time=None):
+    """Save performance of model (and time spent compiling it) to a file"""
     with open(filename, "w") as file:
         file.write("%f\n" % time_elapsed)
         file.write("%f " % test_set_loss)
+        if compile_time is not None:
+            file.write("\n%f" % compile_time)
 
 
 def save_history(filename, history):
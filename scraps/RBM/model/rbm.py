@@ -18,6 +18,7 @@ import os
 import scipy
 import cPickle
 import gzip
+import json
 #this importing of matplotlib is needed to run on the cluster
 #due to issues with displaying imagers
 import matplotlib
@@ -45,12 +46,36 @@ def relu(x):
     """Rectified linear units activation function implemented using Theano"""
     return T.switch(x < 0, 0, x) 
 
+def load_memmap_data(directory):
+    """Load datasets from a memory-mapped dataset directory (no copying)"""
+    with open(os.path.join(directory, "header.json")) as file:
+        header = json.load(file)
+    datasets = []
+    for name in ("train", "valid", "test"):
+        dataset = []
+        for part in ("x", "y"):
+            filename = os.path.join(directory, "%s_%s.bin" % (name, part))
+            shape = tuple(header["shapes"][name][part])
+            if shape[0] == 0:
+                # The empty file of a split without chunks can't be mapped
+                dataset.append(numpy.empty(shape, dtype=header["dtype"]))
+            else:
+                dataset.append(numpy.memmap(filename, dtype=header["dtype"],
+                                            mode="r", shape=shape))
+        datasets.append(tuple(dataset))
+    return datasets
+
 #from logistic_sgd import load_data
 def load_data(filename):
 
+    # Map raw datasets from a memory-mapped dataset directory
+    if os.path.isdir(filename):
+        train_set, valid_set, test_set = load_memmap_data(filename)
+
     # Unpickle raw datasets from file as numpy arrays
-    with gzip.open(filename, 'rb') as file:
-        train_set, valid_set, test_set = cPickle.load(file)
+    else:
+        with gzip.open(filename, 'rb') as file:
+            train_set, valid_set, test_set = cPickle.load(file)
 
     def shared_dataset(data_xy, borrow=True):
         """Load the dataset data_xy into shared variables"""
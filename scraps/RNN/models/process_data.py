@@ -1,5 +1,6 @@
 import cPickle
 import gzip
+import json
 import numpy as np
 import os
 import theano
@@ -41,6 +42,25 @@ def prepare_data(seqs, labels, maxlen=None):
 
     return x, x_mask, labels
 
+def load_memmap_data(directory):
+    """Load datasets from a memory-mapped dataset directory (no copying)"""
+    with open(os.path.join(directory, "header.json")) as f:
+        header = json.load(f)
+    datasets = []
+    for name in ("train", "valid", "test"):
+        dataset = []
+        for part in ("x", "y"):
+            filename = os.path.join(directory, "%s_%s.bin" % (name, part))
+            shape = tuple(header["shapes"][name][part])
+            if shape[0] == 0:
+                # The empty file of a split without chunks can't be mapped
+                dataset.append(np.empty(shape, dtype=header["dtype"]))
+            else:
+                dataset.append(np.memmap(filename, dtype=header["dtype"],
+                                         mode="r", shape=shape))
+        datasets.append(tuple(dataset))
+    return datasets
+
 def load_data(path="../../datasets/qri.pkl.gz", valid_portion=0.1, maxlen=None,
               sort_by_len=False):
     """Loads the dataset
@@ -62,6 +82,10 @@ def load_data(path="../../datasets/qri.pkl.gz", valid_portion=0.1, maxlen=None,
     #############
     # LOAD DATA #
     #############
+    if os.path.isdir(path):
+        # Memory-mapped dataset directory: header.json plus raw x/y arrays
+        return load_memmap_data(path)
+
     if path.endswith(".gz"):
         f = gzip.open(path, "rb")
     else:
@@ -4,8 +4,11 @@ connected, and recurrent layers"""
 import copy
 import cPickle
 import gzip
+import json
 import matplotlib.pyplot as plt
 import numpy as np
+import os
+import sys
 import theano
 import theano.tensor as T
 import time
@@ -13,6 +16,11 @@ import warnings
 from layers1d import ConvPoolLayer, FullyConnectedLayer, RecurrentLayer, Layer
 from nnet_fns import abs_error_cost, relu
 
+# The figure export pool is shared with keras/qri.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "..", "..", "keras"))
+import figure_export
+
 
 # Ignore warnings
 warnings.simplefilter("ignore")
@@ -20,7 +28,20 @@ warnings.simplefilter("ignore")
 
 # Configure floating point numbers for Theano
 theano.config.floatX = "float32"
-    
+
+
+def draw_chunk(graph, x, y, prediction, mean_cost):
+    """Draw a chunk with its prediction and mean cost on a subplot"""
+    graph.set_xlabel("Month", fontsize=15)
+    graph.set_ylabel("Production", fontsize=15)
+    graph.set_title("Mean Cost: %f" % mean_cost, fontsize=10)
+
+    # Plot the prediction (blue), future (green) and past (red)
+    graph.plot(np.append(x, prediction), "b-o", label="Prediction")
+    graph.plot(np.append(x, y), "g-o", label="Future")
+    graph.plot(x, "r-o", label="Past")
+    graph.legend(loc="upper left")
+
 
 class NNet1D(object):
     """A neural network implemented for 1D neural networks in Theano"""
@@ -220,12 +241,39 @@ class NNet1D(object):
         # Return the updates
         return updates
 
+    @staticmethod
+    def load_memmap_data(directory):
+        """Load the datasets from a memory-mapped dataset directory without
+        copying them"""
+        with open(os.path.join(directory, "header.json")) as file:
+            header = json.load(file)
+        datasets = []
+        for name in ("train", "valid", "test"):
+            dataset = []
+            for part in ("x", "y"):
+                filename = os.path.join(directory, "%s_%s.bin" % (name, part))
+                shape = tuple(header["shapes"][name][part])
+                if shape[0] == 0:
+                    # The empty file of a split without chunks can't be mapped
+                    dataset.append(np.empty(shape, dtype=header["dtype"]))
+                else:
+                    dataset.append(np.memmap(filename, dtype=header["dtype"],
+                                             mode="r", shape=shape))
+            datasets.append(tuple(dataset))
+        return datasets
+
     @staticmethod
     def load_data(filename):
-        """Load the datasets from file with filename"""
+        """Load the datasets from file with filename (or from a
+        memory-mapped dataset directory)"""
+        # Map raw datasets from a memory-mapped dataset directory
+        if os.path.isdir(filename):
+            train_set, valid_set, test_set = NNet1D.load_memmap_data(filename)
+
         # Unpickle raw datasets from file as numpy arrays
-        with gzip.open(filename, 'rb') as file:
-            train_set, valid_set, test_set = cPickle.load(file)
+        else:
+            with gzip.open(filename, 'rb') as file:
+                train_set, valid_set, test_set = cPickle.load(file)
     
         def shared_dataset(data_xy, borrow=True):
             """Load the dataset data_xy into shared variables"""
@@ -258,37 +306,14 @@ class NNet1D(object):
                               output_folder="images", output_format="png"):
         """Plots the predictions for the first batch of the test set"""
         # Load test data and make prediction
-        x = self.test_set_x.get_value(borrow=True)
-        y = self.test_set_y.get_value(borrow=True)
-        prediction = self.output(x)
+        x, y, prediction, costs = self.test_predictions()
 
         # Plot each chunk with its prediction
-        for i, chunk in enumerate(zip(x, y, prediction)):
-            # Create a figure and add a subplot with labels
+        for i, chunk in enumerate(zip(x, y, prediction, costs)):
+            # Create a figure and draw the chunk with labels
             fig = plt.figure(i)
-            graph = fig.add_subplot(111)
             fig.suptitle("Chunk Data", fontsize=25)
-            plt.xlabel("Month", fontsize=15)
-            plt.ylabel("Production", fontsize=15)
-
-            # Make and display error label
-            mean_cost = abs_error_cost(chunk[1], chunk[2]).eval()
-            plt.title("Mean Cost: %f" % mean_cost, fontsize=10)
-
-            # Plot the predictions as a blue line with round markers
-            prediction = np.append(chunk[0], chunk[2])
-            graph.plot(prediction, "b-o", label="Prediction")
-
-            # Plot the future as a green line with round markers
-            future = np.append(chunk[0], chunk[1])
-            graph.plot(future, "g-o", label="Future")
-
-            # Plot the past as a red line with round markers
-            past = chunk[0]
-            graph.plot(past, "r-o", label="Past")
-
-            # Add legend
-            plt.legend(loc="upper left")
+            draw_chunk(fig.add_subplot(111), *chunk)
 
             # Save the graphs to a folder
             if save_figs:
@@ -302,6 +327,28 @@ class NNet1D(object):
             # Clear the graph
             plt.close(fig)
 
+    def test_predictions(self):
+        """Return the test chunks (x, y), the prediction for each one and its
+        mean absolute error, computed once for the whole test set"""
+        x = self.test_set_x.get_value(borrow=True)
+        y = self.test_set_y.get_value(borrow=True)
+        prediction = self.output(x)
+        return x, y, prediction, np.abs(y - prediction).mean(axis=1)
+
+    def export_test_predictions(self, output_folder="images",
+                                output_format="png", grid=(1, 1),
+                                pdf_filename=None, workers=None):
+        """Save plots of the test chunks with their predictions using a pool
+        of processes; grid gives the (rows, cols) of chunks per page (a
+        contact sheet), and pdf_filename writes all pages to a single PDF of
+        raster images instead of one file per page. Return the filenames
+        written"""
+        return figure_export.export_pages(draw_chunk,
+                                          self.test_predictions(),
+                                          "Chunk Data", output_folder,
+                                          output_format, grid, pdf_filename,
+                                          workers)
+
     def plot_train_valid_error(self, model_name=""):
         """Plot the training and validation error as a function of epochs.
         Return the graph used (to allow plotting multiple curves)"""